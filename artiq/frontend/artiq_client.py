@@ -37,11 +37,36 @@ def get_argparser():
         help="run the experiment in timed mode. "
              "argument specifies the time of the first run, "
              "use 'now' to run immediately")
+    parser_add.add_argument(
+        "-P", "--period", default=None, type=float,
+        help="run the experiment in timed mode every PERIOD seconds, "
+             "starting at the time given with -T (default: now)")
+    parser_add.add_argument(
+        "-c", "--cron", default=None, type=str,
+        help="run the experiment in timed mode at the times given by a "
+             "cron expression (minute hour day month weekday)")
+    parser_add.add_argument(
+        "--catch-up", default=None, choices=["once", "all"],
+        help="for recurring experiments, whether to run once or for each "
+             "missed time when times are missed (default: once)")
     parser_add.add_argument(
         "-t", "--timeout", default=None, type=float,
         help="specify a timeout for the experiment to complete")
     parser_add.add_argument("-u", "--unit", default=None,
                             help="unit to run")
+    parser_add.add_argument(
+        "-r", "--resource", default=None, action="append",
+        help="resource (e.g. device) claimed by the experiment, can be "
+             "repeated. Experiments that claim no common resource can run "
+             "concurrently. By default, the core device is claimed. "
+             "Use an empty string to claim no resource")
+    parser_add.add_argument(
+        "-p", "--priority", default=None, type=int,
+        help="priority of the experiment (higher runs first, default 0)")
+    parser_add.add_argument(
+        "-d", "--due-date", default=None, type=str,
+        help="date by which the experiment should run. Among experiments "
+             "of the same priority, the earliest due date runs first")
     parser_add.add_argument("file", help="file containing the unit to run")
     parser_add.add_argument("arguments", nargs="*",
                             help="run arguments")
@@ -74,6 +99,17 @@ def get_argparser():
         "del-parameter", help="delete a parameter")
     parser_del_parameter.add_argument("name", help="name of the parameter")
 
+    parser_parameter_history = subparsers.add_parser(
+        "parameter-history", help="show the history of a parameter")
+    parser_parameter_history.add_argument(
+        "--start", default=None, type=str,
+        help="show changes made after this time")
+    parser_parameter_history.add_argument(
+        "--end", default=None, type=str,
+        help="show changes made before this time")
+    parser_parameter_history.add_argument("name",
+                                          help="name of the parameter")
+
     parser_show = subparsers.add_parser(
         "show", help="show schedule, devices or parameters")
     parser_show.add_argument(
@@ -103,11 +139,22 @@ def _action_submit(remote, args):
         "unit": args.unit,
         "arguments": arguments
     }
-    if args.timed is None:
+    if args.resource is not None:
+        run_params["resources"] = [r for r in args.resource if r]
+    if args.priority is not None:
+        run_params["priority"] = args.priority
+    if args.due_date is not None:
+        run_params["due_date"] = time.mktime(
+            parse_date(args.due_date).timetuple())
+    for option in "period", "cron", "catch_up":
+        value = getattr(args, option)
+        if value is not None:
+            run_params[option] = value
+    if args.timed is None and args.period is None and args.cron is None:
         rid = remote.run_queued(run_params, args.timeout)
         print("RID: {}".format(rid))
     else:
-        if args.timed == "now":
+        if args.timed is None or args.timed == "now":
             next_time = None
         else:
             next_time = time.mktime(parse_date(args.timed).timetuple())
@@ -138,6 +185,21 @@ def _action_del_parameter(remote, args):
     remote.delete(args.name)
 
 
+def _action_parameter_history(remote, args):
+    start, end = [None if t is None
+                  else time.mktime(parse_date(t).timetuple())
+                  for t in (args.start, args.end)]
+    table = PrettyTable(["Time", "Value"])
+    for change in remote.get_changes(args.name, start, end):
+        row = [time.strftime("%m/%d %H:%M:%S", time.localtime(change[0]))]
+        if len(change) == 1:
+            row.append("(deleted)")
+        else:
+            row.append(str(change[1]))
+        table.add_row(row)
+    print(table)
+
+
 def _show_queue(queue):
     clear_screen()
     if queue:
@@ -249,6 +311,7 @@ def main():
             "del_device": "master_ddb",
             "set_parameter": "master_pdb",
             "del_parameter": "master_pdb",
+            "parameter_history": "master_pdb_history",
         }[action]
         remote = Client(args.server, port, target_name)
         try:
@@ -6,7 +6,8 @@ import atexit
 
 from artiq.protocols.pc_rpc import Server
 from artiq.protocols.sync_struct import Publisher
-from artiq.protocols.file_db import FlatFileDB, SimpleHistory
+from artiq.protocols.file_db import (FlatFileDB, SimpleHistory,
+                                     PersistentHistory)
 from artiq.master.scheduler import Scheduler
 from artiq.master.rt_results import RTResults
 from artiq.master.repository import Repository
@@ -23,6 +24,26 @@ def get_argparser():
     parser.add_argument(
         "--port-control", default=3251, type=int,
         help="TCP port to listen to for control")
+    parser.add_argument(
+        "--notify-window", default=0.05, type=float,
+        help="time window in seconds during which notifications are "
+             "coalesced (0 to send them immediately)")
+    parser.add_argument(
+        "--notify-queue-limit", default=1000, type=int,
+        help="number of notification frames that may wait to be sent to "
+             "a client before it is resynchronized")
+    parser.add_argument(
+        "--notify-resume-buffer", default=16*1024*1024, type=int,
+        help="maximum size in bytes of the notification frames kept for "
+             "each structure to resume the subscriptions of clients that "
+             "reconnect (0 to disable)")
+    parser.add_argument(
+        "--workers", default=4, type=int,
+        help="number of worker processes, i.e. of experiments that can "
+             "run concurrently if they claim no common resource")
+    parser.add_argument(
+        "--isolate", default=False, action="store_true",
+        help="run each experiment in a new worker process")
     return parser
 
 
@@ -30,9 +51,13 @@ def main():
     args = get_argparser().parse_args()
 
     ddb = FlatFileDB("ddb.pyon")
-    pdb = FlatFileDB("pdb.pyon")
+    pdb = FlatFileDB("pdb.pyon", journal=True)
+    atexit.register(pdb.close)
     simplephist = SimpleHistory(30)
     pdb.hooks.append(simplephist)
+    pdb_history = PersistentHistory("pdb_history.dat")
+    atexit.register(pdb_history.close)
+    pdb.hooks.append(pdb_history)
     rtr = RTResults()
     repository = Repository()
 
@@ -44,14 +69,17 @@ def main():
         "req_parameter": pdb.request,
         "set_parameter": pdb.set,
         "init_rt_results": rtr.init,
-        "update_rt_results": rtr.update
-    })
+        "update_rt_results": rtr.update,
+        "finish_rt_results": rtr.finish
+    }, n_workers=args.workers, isolate=args.isolate)
+    pdb.hooks.append(scheduler.parameter_hook)
     loop.run_until_complete(scheduler.start())
     atexit.register(lambda: loop.run_until_complete(scheduler.stop()))
 
     server_control = Server({
         "master_ddb": ddb,
         "master_pdb": pdb,
+        "master_pdb_history": pdb_history,
         "master_schedule": scheduler,
         "master_repository": repository
     })
@@ -66,7 +94,9 @@ def main():
         "parameters": pdb.data,
         "parameters_simplehist": simplephist.history,
         "rt_results": rtr.groups
-    })
+    }, coalesce_window=args.notify_window or None,
+       queue_limit=args.notify_queue_limit,
+       resume_buffer=args.notify_resume_buffer or None)
     loop.run_until_complete(server_notify.start(
         args.bind, args.port_notify))
     atexit.register(lambda: loop.run_until_complete(server_notify.stop()))
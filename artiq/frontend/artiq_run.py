@@ -105,7 +105,11 @@ def main():
                 sys.exit(1)
 
             unit_inst = unit(dbh, **arguments)
+            if hasattr(unit_inst, "prepare"):
+                unit_inst.prepare()
             unit_inst.run()
+            if hasattr(unit_inst, "analyze"):
+                unit_inst.analyze()
 
             if rdb.data.read or rdb.realtime_data.read:
                 print("Results:")
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from artiq.devices.lda.driver import Lda, Ldasim
 from artiq.protocols.pc_rpc import simple_server_loop
@@ -25,8 +26,10 @@ def main():
         lda = Ldasim()
     else:
         lda = Lda(args.serial, args.device)
-    simple_server_loop({"lda": lda},
-                       args.bind, args.port)
+    # HID transfers block, run them outside the event loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        simple_server_loop({"lda": lda},
+                           args.bind, args.port, executor=executor)
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@
 
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from artiq.devices.pdq2.driver import Pdq2
 from artiq.protocols.pc_rpc import simple_server_loop
@@ -32,8 +33,11 @@ def main():
 
     dev = Pdq2(serial=args.serial)
     try:
-        simple_server_loop({"pdq2": dev}, args.bind, args.port,
-                           id_parameters="serial=" + str(args.serial))
+        # USB transfers block, run them outside the event loop
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            simple_server_loop({"pdq2": dev}, args.bind, args.port,
+                               id_parameters="serial=" + str(args.serial),
+                               executor=executor)
     finally:
         dev.close()
 
@@ -142,7 +142,8 @@ class RTResults:
     @asyncio.coroutine
     def sub_connect(self, host, port):
         self.sets_subscriber = Subscriber("rt_results",
-                                          self.init_groups, self.on_mod)
+                                          self.init_groups, self.on_mod,
+                                          binary=True)
         yield from self.sets_subscriber.connect(host, port)
 
     @asyncio.coroutine
@@ -68,6 +68,10 @@ class ListSyncer:
     def append(self, x):
         self.store.append(self.convert(x))
 
+    def extend(self, l):
+        for x in l:
+            self.append(x)
+
     def insert(self, i, x):
         self.store.insert(i, self.convert(x))
 
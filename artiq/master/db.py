@@ -2,6 +2,7 @@ from collections import OrderedDict
 import importlib
 
 from artiq.protocols.sync_struct import Notifier
+from artiq.protocols.pc_rpc import ClientPool
 
 
 class ResultDB:
@@ -36,10 +37,23 @@ class DBHub:
     """Connects device, parameter and result databases to experiment.
     Handle device driver creation and destruction.
 
+    Devices described with ``"type": "controller"`` in the device database
+    are RPC clients to the controller at ``host``/``port`` with target
+    ``target_name``. They are taken from ``client_pool``, so that their
+    connections remain open after ``close``. If no pool is given, a private
+    one is used and closed with the ``DBHub``.
+
     """
-    def __init__(self, ddb, pdb, rdb):
+    def __init__(self, ddb, pdb, rdb, client_pool=None):
         self.ddb = ddb
         self.active_devices = OrderedDict()
+        self.active_controllers = dict()
+        if client_pool is None:
+            self.client_pool = ClientPool()
+            self._own_client_pool = True
+        else:
+            self.client_pool = client_pool
+            self._own_client_pool = False
 
         self.get_parameter = pdb.request
         self.set_parameter = pdb.set
@@ -49,13 +63,20 @@ class DBHub:
     def get_device(self, name):
         if name in self.active_devices:
             return self.active_devices[name]
+        elif name in self.active_controllers:
+            return self.active_controllers[name]
         else:
             desc = self.ddb.request(name)
             while isinstance(desc, str):
                 # alias
                 desc = self.ddb.request(desc)
-            dev = _create_device(desc, self)
-            self.active_devices[name] = dev
+            if desc.get("type", "local") == "controller":
+                dev = self.client_pool.get(desc["host"], desc["port"],
+                                           desc["target_name"])
+                self.active_controllers[name] = dev
+            else:
+                dev = _create_device(desc, self)
+                self.active_devices[name] = dev
             return dev
 
     def close(self):
@@ -69,3 +90,5 @@ class DBHub:
         for dev in reversed(list(self.active_devices.values())):
             if hasattr(dev, "close"):
                 dev.close()
+        if self._own_client_pool:
+            self.client_pool.close()
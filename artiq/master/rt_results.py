@@ -2,11 +2,22 @@ from artiq.protocols.sync_struct import Notifier, process_mod
 
 
 class RTResults:
+    """Realtime results of the experiments, in groups keyed by RID, so that
+    experiments running concurrently each have their own.
+
+    The group of an experiment is kept after its run phase until a new
+    group is initialized.
+
+    """
     def __init__(self):
         self.groups = Notifier(dict())
-        self.current_group = "default"
+        # RIDs of the groups whose experiment has finished running
+        self.finished = set()
 
-    def init(self, description):
+    def init(self, rid, description):
+        for finished_rid in self.finished:
+            del self.groups[finished_rid]
+        self.finished.clear()
         data = dict()
         for rtr in description.keys():
             if isinstance(rtr, tuple):
@@ -14,11 +25,18 @@ class RTResults:
                     data[e] = []
             else:
                 data[rtr] = []
-        self.groups[self.current_group] = {
+        self.groups[rid] = {
             "description": description,
             "data": data
         }
 
-    def update(self, mod):
-        target = self.groups[self.current_group]["data"]
+    def update(self, rid, mod):
+        """Applies a mod, which can be a batch of mods, to the data of the
+        group of an experiment.
+
+        """
+        target = self.groups[rid]["data"]
         process_mod(target, mod)
+
+    def finish(self, rid):
+        self.finished.add(rid)
@@ -1,18 +1,226 @@
 import asyncio
+import heapq
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from math import floor
 from time import time
 
 from artiq.protocols.sync_struct import Notifier
-from artiq.master.worker import Worker
+from artiq.master.worker import Worker, WorkerFailed
+
+
+class _ParameterHook:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def set(self, timestamp, name, value):
+        for worker in self.scheduler.workers:
+            worker.invalidate_parameter(name)
+
+    def delete(self, timestamp, name):
+        for worker in self.scheduler.workers:
+            worker.invalidate_parameter(name)
+
+
+def get_resources(run_params):
+    """Returns the set of resources claimed by an experiment.
+
+    The resources are given by the optional ``resources`` entry of the run
+    parameters, a list of names (e.g. of devices). Experiments without
+    this entry claim the core device (``"core"``).
+
+    """
+    resources = run_params.get("resources")
+    if resources is None:
+        return {"core"}
+    else:
+        return set(resources)
+
+
+def _parse_cron_field(field, minimum, maximum):
+    values = set()
+    for part in field.split(","):
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+            if step < 1:
+                raise ValueError("Invalid step in cron expression")
+        else:
+            step = 1
+        if part == "*":
+            start, end = minimum, maximum
+        elif "-" in part:
+            start, end = map(int, part.split("-"))
+        else:
+            start = int(part)
+            end = maximum if step > 1 else start
+        if not minimum <= start <= end <= maximum:
+            raise ValueError("Value out of range in cron expression")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """A recurring schedule given by a cron expression, made of five
+    fields separated by spaces: minute (0-59), hour (0-23), day of the
+    month (1-31), month (1-12) and day of the week (0-7, 0 and 7 being
+    Sunday), in local time.
+
+    Each field is ``*`` or a comma-separated list of values, ranges
+    (``a-b``) and steps (``*/n``, ``a-b/n`` or ``a/n``). As in cron, if
+    both the day of the month and the day of the week are restricted,
+    days matching either of them are selected.
+
+    """
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expressions have 5 fields")
+        self.minutes = sorted(_parse_cron_field(fields[0], 0, 59))
+        self.hours = sorted(_parse_cron_field(fields[1], 0, 23))
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, date):
+        if date.month not in self.months:
+            return False
+        day = date.day in self.days
+        # Python counts days of the week from Monday
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        else:
+            return day or weekday
+
+    def next_time(self, t):
+        """Returns the first time of the schedule strictly after ``t``.
+
+        """
+        start = datetime.fromtimestamp(t).replace(second=0, microsecond=0)
+        start += timedelta(minutes=1)
+        date = start.replace(hour=0, minute=0)
+        # the calendar repeats every 28 years between 1901 and 2099
+        for i in range(28*366):
+            if self._day_matches(date):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = date.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate.timestamp()
+            date += timedelta(days=1)
+        raise ValueError("Cron expression never matches")
+
+
+def _get_recurrence(run_params):
+    # Returns a function giving the next scheduled time after a scheduled
+    # time and the current time, or None if the experiment does not recur.
+    period = run_params.get("period")
+    cron = run_params.get("cron")
+    if period is not None and cron is not None:
+        raise ValueError("Both period and cron expression given")
+    if period is not None:
+        if period <= 0:
+            raise ValueError("Period must be positive")
+        # multiples of the period after the first scheduled time, so that
+        # the schedule does not drift
+        return lambda scheduled, now: (
+            scheduled + period*(floor((now - scheduled)/period) + 1))
+    elif cron is not None:
+        cron_schedule = CronSchedule(cron)
+        return lambda scheduled, now: cron_schedule.next_time(
+            max(scheduled, now))
+    else:
+        return None
+
+
+def _queue_key(rid, run_params):
+    # higher priorities first, then earlier due dates, then in the order of
+    # submission
+    due_date = run_params.get("due_date")
+    if due_date is None:
+        due_date = float("inf")
+    return -run_params.get("priority", 0), due_date, rid
 
 
 class Scheduler:
-    def __init__(self, worker_handlers):
-        self.worker = Worker(worker_handlers)
+    """Runs the queued and timed experiments in a pool of ``n_workers``
+    worker processes.
+
+    Experiments run concurrently unless they claim a common resource (see
+    ``get_resources``), in which case they run in the order of the queue.
+    An experiment waits until all experiments before it in the queue that
+    claim a common resource have started, so that it does not overtake
+    them.
+
+    The queue is ordered by priority (the optional ``priority`` entry of
+    the run parameters, an integer defaulting to 0, higher first), then by
+    due date (the optional ``due_date`` entry, a time as returned by
+    ``time.time``, earlier first, experiments without due date last), and
+    then by order of submission. When a timed experiment becomes due, it
+    is queued with its scheduled time as due date, so that it runs before
+    the queued experiments of the same priority without due date.
+
+    Timed experiments recur if their run parameters contain ``period``
+    (in seconds) or ``cron`` (an expression for ``CronSchedule``). The
+    next scheduled time is computed from the previous one, not from the
+    time at which the experiment ran, and updated in ``timed``. The
+    ``catch_up`` entry of the run parameters determines what happens when
+    scheduled times are missed (e.g. because the master was not running)
+    or when the previous run has not started yet (e.g. because the queue
+    is busy): with ``"once"`` (the default), the experiment is queued
+    once for all missed times, and not queued again while the previous
+    run is waiting; with ``"all"``, it is queued for every scheduled time.
+
+    Experiments are executed in three stages, in the same worker:
+    prepare (see ``Worker.prepare``), run and analyze. An experiment holds
+    its resources during all of them: it creates its devices when it is
+    prepared and closes them at the end of the analyze stage, and the
+    experiments after it that claim the same resources may use parameters
+    it sets (e.g. calibrations) until then.
+
+    A spare worker process is kept ready to replace a worker whose process
+    has failed, and the worker that ran an experiment is also replaced if
+    ``isolate`` is set, or if the run parameters contain ``"isolate":
+    True``, so that the next experiments run in a new process. If the spare
+    worker failed to start, the process of the worker is restarted instead,
+    every ``restart_delay`` seconds until it succeeds.
+
+    """
+    def __init__(self, worker_handlers, n_workers=1, isolate=False,
+                 restart_delay=5.0):
+        self.worker_handlers = worker_handlers
+        self.isolate = isolate
+        self.restart_delay = restart_delay
+        self.workers = [Worker(worker_handlers) for i in range(n_workers)]
+        self.idle_workers = list(self.workers)
+        # to be added to the hooks of the parameter database, so that
+        # workers do not use cached values of modified parameters
+        self.parameter_hook = _ParameterHook(self)
         self.next_rid = 0
         self.queue = Notifier([])
+        # sort keys of the queue entries, in the order of the queue
+        self._queue_keys = []
+        # RID -> sort key
+        self._queue_index = dict()
         self.queue_modified = asyncio.Event()
         self.timed = Notifier(dict())
+        # (next_run, TRID) for all timed experiments, and for cancelled
+        # ones until they reach the top of the heap (lazy deletion)
+        self._timed_heap = []
+        self._timed_cancelled = 0
+        self._next_trid = 0
+        self._free_trids = []
+        # TRID -> RID of the last run queued for recurring experiments
+        self._recurring_rids = dict()
         self.timed_modified = asyncio.Event()
+        # RID -> "prepare", "run" or "analyze", for the started experiments
+        self.stages = dict()
+        # RID -> resources, for the started experiments
+        self.running = dict()
+        self.run_tasks = set()
 
     def new_rid(self):
         r = self.next_rid
@@ -20,105 +228,253 @@ class Scheduler:
         return r
 
     def new_trid(self):
-        trids = set(range(len(self.timed.read) + 1))
-        trids -= set(self.timed.read.keys())
-        return next(iter(trids))
+        # the lowest TRID that is not in use
+        if self._free_trids:
+            return heapq.heappop(self._free_trids)
+        else:
+            r = self._next_trid
+            self._next_trid += 1
+            return r
+
+    def _queue_insert(self, rid, run_params, timeout):
+        key = _queue_key(rid, run_params)
+        idx = bisect_left(self._queue_keys, key)
+        self._queue_keys.insert(idx, key)
+        self._queue_index[rid] = key
+        self.queue.insert(idx, (rid, run_params, timeout))
+
+    def _queue_remove(self, rid):
+        key = self._queue_index.pop(rid)
+        idx = bisect_left(self._queue_keys, key)
+        del self._queue_keys[idx]
+        del self.queue[idx]
+
+    def _timed_remove(self, trid):
+        del self.timed[trid]
+        self._recurring_rids.pop(trid, None)
+        heapq.heappush(self._free_trids, trid)
+
+    @asyncio.coroutine
+    def _create_spare(self):
+        worker = Worker(self.worker_handlers)
+        yield from worker.create_process()
+        return worker
+
+    @asyncio.coroutine
+    def _replace_worker(self, worker):
+        # the process of the worker has been ended
+        try:
+            # not cancelled with this task, so that stop can end it
+            spare = yield from asyncio.shield(self.spare_task)
+        except Exception as e:
+            print("Failed to start spare worker:")
+            print(e)
+            spare = None
+        self.spare_task = asyncio.Task(self._create_spare())
+        if spare is None:
+            # Restart the process of the worker instead. It is kept out of
+            # the idle workers until it is ready, so that no experiment is
+            # sent to it in the meantime.
+            while True:
+                try:
+                    yield from worker.create_process()
+                except Exception as e:
+                    print("Failed to restart worker:")
+                    print(e)
+                    yield from worker.end_process()
+                    yield from asyncio.sleep(self.restart_delay)
+                else:
+                    return worker
+        self.workers[self.workers.index(worker)] = spare
+        return spare
 
     @asyncio.coroutine
     def start(self):
+        yield from asyncio.gather(*[worker.create_process()
+                                    for worker in self.workers])
+        self.spare_task = asyncio.Task(self._create_spare())
         self.task = asyncio.Task(self._schedule())
-        yield from self.worker.create_process()
 
     @asyncio.coroutine
     def stop(self):
         self.task.cancel()
         yield from asyncio.wait([self.task])
         del self.task
-        yield from self.worker.end_process()
+        tasks = list(self.run_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            yield from asyncio.wait(tasks)
+        for worker in self.workers:
+            yield from worker.end_process()
+        try:
+            spare = yield from self.spare_task
+        except Exception:
+            pass
+        else:
+            yield from spare.end_process()
+        del self.spare_task
 
     def run_queued(self, run_params, timeout):
         rid = self.new_rid()
-        self.queue.append((rid, run_params, timeout))
+        self._queue_insert(rid, run_params, timeout)
         self.queue_modified.set()
         return rid
 
     def cancel_queued(self, rid):
-        idx = next(idx for idx, (qrid, _, _)
-                   in enumerate(self.queue.read)
-                   if qrid == rid)
-        if idx == 0:
-            # Cannot cancel when already running
+        if rid in self.stages:
+            # Cannot cancel when already started
             raise NotImplementedError
-        del self.queue[idx]
+        self._queue_remove(rid)
 
     def run_timed(self, run_params, timeout, next_run):
+        recurrence = _get_recurrence(run_params)
+        if run_params.get("catch_up", "once") not in ("once", "all"):
+            raise ValueError("Unknown catch-up policy")
         if next_run is None:
             next_run = time()
+            if "cron" in run_params:
+                next_run = recurrence(next_run, next_run)
         trid = self.new_trid()
         self.timed[trid] = next_run, run_params, timeout
+        heapq.heappush(self._timed_heap, (next_run, trid))
         self.timed_modified.set()
         return trid
 
     def cancel_timed(self, trid):
-        del self.timed[trid]
+        self._timed_remove(trid)
+        self._timed_cancelled += 1
+        if self._timed_cancelled > len(self._timed_heap)//2:
+            # rebuild the heap without the cancelled experiments
+            self._timed_heap = [(params[0], trid) for trid, params
+                                in self.timed.read.items()]
+            heapq.heapify(self._timed_heap)
+            self._timed_cancelled = 0
 
     @asyncio.coroutine
-    def _run(self, rid, run_params, timeout):
+    def _run(self, worker, rid, run_params, timeout):
+        replace = self.isolate or run_params.get("isolate", False)
         try:
-            yield from self.worker.run(run_params, timeout)
-        except Exception as e:
-            print("RID {} failed:".format(rid))
-            print(e)
-        else:
-            print("RID {} completed successfully".format(rid))
-
-    @asyncio.coroutine
-    def _run_timed(self):
-        while True:
-            min_next_run = None
-            min_trid = None
-            for trid, params in self.timed.read.items():
-                if min_next_run is None or params[0] < min_next_run:
-                    min_next_run = params[0]
-                    min_trid = trid
-
-            now = time()
+            try:
+                yield from worker.prepare(rid, run_params, timeout)
+                self.stages[rid] = "run"
+                yield from worker.run_prepared(timeout)
+                self.stages[rid] = "analyze"
+                yield from worker.analyze(timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("RID {} failed:".format(rid))
+                print(e)
+                if isinstance(e, WorkerFailed):
+                    replace = True
+            else:
+                print("RID {} completed successfully".format(rid))
+            if replace:
+                # a failed worker process may still have devices open
+                yield from worker.end_process()
+        finally:
+            # The devices of the experiment are closed, so its resources
+            # can be released.
+            del self.stages[rid]
+            del self.running[rid]
+            self._queue_remove(rid)
+            self.queue_modified.set()
+        if replace:
+            worker = yield from self._replace_worker(worker)
+        self.idle_workers.append(worker)
+        self.queue_modified.set()
 
-            if min_next_run is None:
-                return None
-            min_next_run -= now
-            if min_next_run > 0:
-                return min_next_run
+    def _queue_timed(self):
+        # Moves the timed experiments that are due to the queue, and
+        # returns the time until the next one is due.
+        now = time()
+        heap = self._timed_heap
+        while heap:
+            next_run, trid = heap[0]
+            params = self.timed.read.get(trid)
+            if params is None or params[0] != next_run:
+                # cancelled (the TRID may have been reused since)
+                heapq.heappop(heap)
+                self._timed_cancelled -= 1
+                continue
+            if next_run > now:
+                return next_run - now
+            heapq.heappop(heap)
+            next_run, run_params, timeout = params
+            recurrence = _get_recurrence(run_params)
+            if recurrence is None:
+                self._timed_remove(trid)
+                self._queue_timed_run(next_run, run_params, timeout)
+            elif run_params.get("catch_up", "once") == "all":
+                while next_run <= now:
+                    rid = self._queue_timed_run(next_run, run_params,
+                                                timeout)
+                    next_run = recurrence(next_run, next_run)
+                self._recurring_rids[trid] = rid
+            else:
+                rid = self._recurring_rids.get(trid)
+                if rid not in self._queue_index or rid in self.stages:
+                    self._recurring_rids[trid] = self._queue_timed_run(
+                        next_run, run_params, timeout)
+                next_run = recurrence(next_run, now)
+            if recurrence is not None:
+                self.timed[trid] = next_run, run_params, timeout
+                heapq.heappush(heap, (next_run, trid))
+        return None
 
-            next_run, run_params, timeout = self.timed.read[min_trid]
-            del self.timed[min_trid]
+    def _queue_timed_run(self, next_run, run_params, timeout):
+        if run_params.get("due_date") is None:
+            run_params = dict(run_params, due_date=next_run)
+        rid = self.new_rid()
+        self._queue_insert(rid, run_params, timeout)
+        return rid
 
-            rid = self.new_rid()
-            self.queue.insert(0, (rid, run_params, timeout))
-            yield from self._run(rid, run_params, timeout)
-            del self.queue[0]
+    def _start_runnable(self):
+        # resources of the started experiments
+        claimed = set()
+        for resources in self.running.values():
+            claimed |= resources
+        # resources of the experiments before the current one in the queue
+        # that have not started
+        waiting = set()
+        for rid, run_params, timeout in self.queue.read:
+            if not self.idle_workers:
+                break
+            if rid in self.running:
+                continue
+            resources = get_resources(run_params)
+            if resources & (claimed | waiting):
+                # experiments after this one must wait if they need
+                # the same resources
+                waiting |= resources
+            else:
+                worker = self.idle_workers.pop()
+                task = asyncio.Task(self._run(worker, rid, run_params,
+                                              timeout))
+                self.stages[rid] = "prepare"
+                self.running[rid] = resources
+                claimed |= resources
+                self.run_tasks.add(task)
+                task.add_done_callback(self.run_tasks.discard)
 
     @asyncio.coroutine
     def _schedule(self):
         while True:
-            next_timed = yield from self._run_timed()
-            if self.queue.read:
-                rid, run_params, timeout = self.queue.read[0]
-                yield from self._run(rid, run_params, timeout)
-                del self.queue[0]
-            else:
-                self.queue_modified.clear()
-                self.timed_modified.clear()
-                t1 = asyncio.Task(self.queue_modified.wait())
-                t2 = asyncio.Task(self.timed_modified.wait())
-                try:
-                    done, pend = yield from asyncio.wait(
-                        [t1, t2],
-                        timeout=next_timed,
-                        return_when=asyncio.FIRST_COMPLETED)
-                except:
-                    t1.cancel()
-                    t2.cancel()
-                    raise
-                for t in pend:
-                    t.cancel()
+            self.queue_modified.clear()
+            self.timed_modified.clear()
+            next_timed = self._queue_timed()
+            self._start_runnable()
+            t1 = asyncio.Task(self.queue_modified.wait())
+            t2 = asyncio.Task(self.timed_modified.wait())
+            try:
+                done, pend = yield from asyncio.wait(
+                    [t1, t2],
+                    timeout=next_timed,
+                    return_when=asyncio.FIRST_COMPLETED)
+            except:
+                t1.cancel()
+                t2.cancel()
+                raise
+            for t in pend:
+                t.cancel()
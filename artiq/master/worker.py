@@ -1,4 +1,5 @@
 import sys
+import os
 import asyncio
 import subprocess
 import signal
@@ -16,26 +17,66 @@ class RunFailed(Exception):
 
 
 class Worker:
+    """Runs experiments in a separate process (``artiq.master.worker_impl``).
+
+    The worker process and the master exchange binary PYON frames over a
+    dedicated pair of pipes, leaving the standard input and output of the
+    worker process to the experiments.
+
+    While running an experiment, the worker process sends requests, which
+    are answered with the value returned by the corresponding handler, and
+    notifications (marked with ``"reply": False``), which are processed
+    in order with the requests but are not answered, so that the worker
+    process does not wait for them.
+
+    """
     def __init__(self, handlers,
-                 send_timeout=0.5, start_reply_timeout=1.0, term_timeout=1.0):
+                 send_timeout=0.5, start_reply_timeout=1.0, term_timeout=1.0,
+                 ready_timeout=30.0):
         self.handlers = handlers
         self.send_timeout = send_timeout
+        self.ready_timeout = ready_timeout
         self.start_reply_timeout = start_reply_timeout
         self.term_timeout = term_timeout
+        self.parameter_cache_stats = None
 
     @asyncio.coroutine
     def create_process(self):
-        self.process = yield from asyncio.create_subprocess_exec(
-            sys.executable, "-m", "artiq.master.worker_impl",
-            stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+        loop = asyncio.get_event_loop()
+        from_worker, worker_out = os.pipe()
+        worker_in, to_worker = os.pipe()
+        try:
+            self.process = yield from asyncio.create_subprocess_exec(
+                sys.executable, "-m", "artiq.master.worker_impl",
+                str(worker_in), str(worker_out),
+                stdin=subprocess.DEVNULL,
+                pass_fds=(worker_in, worker_out))
+        except:
+            os.close(from_worker)
+            os.close(to_worker)
+            raise
+        finally:
+            os.close(worker_in)
+            os.close(worker_out)
+        self._reader = asyncio.StreamReader()
+        self._reader_transport, _ = yield from loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._reader),
+            open(from_worker, "rb", buffering=0))
+        transport, protocol = yield from loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin,
+            open(to_worker, "wb", buffering=0))
+        self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        # the worker process imports the modules that experiments commonly
+        # need before it reports that it is ready
+        obj = yield from self._recv(self.ready_timeout)
+        if obj != "ready":
+            raise WorkerFailed("Incorrect ready message")
 
     @asyncio.coroutine
     def _send(self, obj, timeout):
-        line = pyon.encode(obj)
-        self.process.stdin.write(line.encode())
-        self.process.stdin.write("\n".encode())
+        self._writer.writelines(pyon.encode_binary(obj))
         try:
-            fut = self.process.stdin.drain()
+            fut = self._writer.drain()
             if fut is not ():  # FIXME: why does Python return this?
                 yield from asyncio.wait_for(fut, timeout=timeout)
         except asyncio.TimeoutError:
@@ -43,25 +84,46 @@ class Worker:
         except:
             raise WorkerFailed("Failed to send data to worker")
 
+    def invalidate_parameter(self, name):
+        """Tells the worker process that a parameter has changed, so that it
+        does not use a value it has cached.
+
+        The notification is sent without waiting for the worker process,
+        which processes it as soon as it receives it, even while running
+        an experiment.
+
+        """
+        if self.process.returncode is None:
+            self._writer.writelines(pyon.encode_binary(
+                {"action": "invalidate_parameter", "name": name}))
+
+    @asyncio.coroutine
+    def _recv_frame(self):
+        header = yield from self._reader.readexactly(
+            pyon.binary_header_size)
+        payload = yield from self._reader.readexactly(
+            pyon.decode_binary_header(header))
+        return payload
+
     @asyncio.coroutine
     def _recv(self, timeout):
         try:
-            line = yield from asyncio.wait_for(
-                self.process.stdout.readline(), timeout=timeout)
+            payload = yield from asyncio.wait_for(
+                self._recv_frame(), timeout=timeout)
         except asyncio.TimeoutError:
             raise WorkerFailed("Timeout receiving data from worker")
-        if not line:
+        except asyncio.IncompleteReadError:
             raise WorkerFailed(
                 "Worker ended unexpectedly while trying to receive data")
         try:
-            obj = pyon.decode(line.decode())
+            obj = pyon.decode_binary(payload)
         except:
             raise WorkerFailed("Worker sent invalid PYON data")
         return obj
 
     @asyncio.coroutine
-    def run(self, run_params, result_timeout):
-        yield from self._send(run_params, self.send_timeout)
+    def _run_phase(self, command, result_timeout):
+        yield from self._send(command, self.send_timeout)
         obj = yield from self._recv(self.start_reply_timeout)
         if obj != "ack":
             raise WorkerFailed("Incorrect acknowledgement")
@@ -69,12 +131,22 @@ class Worker:
             obj = yield from self._recv(result_timeout)
             action = obj["action"]
             if action == "report_completed":
+                for k, v in obj["parameter_cache"].items():
+                    self.parameter_cache_stats[k] += v
                 if obj["status"] != "ok":
                     raise RunFailed(obj["message"])
                 else:
                     return
             else:
                 del obj["action"]
+                if not obj.pop("reply", True):
+                    try:
+                        self.handlers[action](**obj)
+                    except:
+                        print("Failed to process {} notification from worker:"
+                              .format(action))
+                        traceback.print_exc()
+                    continue
                 try:
                     data = self.handlers[action](**obj)
                     reply = {"status": "ok", "data": data}
@@ -83,13 +155,55 @@ class Worker:
                              "message": traceback.format_exc()}
                 yield from self._send(reply, self.send_timeout)
 
+    @asyncio.coroutine
+    def prepare(self, rid, run_params, result_timeout):
+        """Loads the experiment and creates its instance (which obtains its
+        parameters and devices), and calls its ``prepare`` method if it has
+        one. Its realtime results go to the group ``rid``.
+
+        If a phase fails (``RunFailed``), the experiment is closed and the
+        next phases must not be executed.
+
+        """
+        self.parameter_cache_stats = {"hits": 0, "misses": 0}
+        yield from self._run_phase({"action": "prepare",
+                                    "rid": rid,
+                                    "run_params": run_params},
+                                   result_timeout)
+
+    @asyncio.coroutine
+    def run_prepared(self, result_timeout):
+        """Calls the ``run`` method of the prepared experiment. Its
+        realtime results are only published during this phase.
+
+        """
+        yield from self._run_phase({"action": "run"}, result_timeout)
+
+    @asyncio.coroutine
+    def analyze(self, result_timeout):
+        """Calls the ``analyze`` method of the experiment if it has one, and
+        closes it.
+
+        """
+        yield from self._run_phase({"action": "analyze"}, result_timeout)
+
+    @asyncio.coroutine
+    def run(self, rid, run_params, result_timeout):
+        """Executes all the phases of an experiment.
+
+        """
+        yield from self.prepare(rid, run_params, result_timeout)
+        yield from self.run_prepared(result_timeout)
+        yield from self.analyze(result_timeout)
+
     @asyncio.coroutine
     def end_process(self):
-        if self.process.returncode is not None:
-            return
-        self.process.send_signal(signal.SIGTERM)
-        try:
-            yield from asyncio.wait_for(
-                self.process.wait(), timeout=self.term_timeout)
-        except asyncio.TimeoutError:
-            self.process.send_signal(signal.SIGKILL)
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                yield from asyncio.wait_for(
+                    self.process.wait(), timeout=self.term_timeout)
+            except asyncio.TimeoutError:
+                self.process.send_signal(signal.SIGKILL)
+        self._writer.close()
+        self._reader_transport.close()
@@ -1,23 +1,89 @@
 import sys
+import importlib
 from inspect import isclass
 import traceback
+import threading
+import queue
+from copy import deepcopy
+from time import monotonic
 
 from artiq.protocols import pyon
+from artiq.protocols.sync_struct import coalesce_mod
+from artiq.protocols.pc_rpc import ClientPool
 from artiq.tools import file_import
 from artiq.language.db import AutoDB
 from artiq.master.db import DBHub, ResultDB
 
 
+# pipes to the master, opened by main
+_ipc_in = None
+_ipc_out = None
+
+
+def _read_object():
+    header = _ipc_in.read(pyon.binary_header_size)
+    if len(header) != pyon.binary_header_size:
+        raise EOFError
+    payload = _ipc_in.read(pyon.decode_binary_header(header))
+    return pyon.decode_binary(payload)
+
+
+class _ParameterCache:
+    def __init__(self):
+        # all attributes are protected by the lock
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, name):
+        with self.lock:
+            self.values.pop(name, None)
+            self.invalidations += 1
+
+
+_parameter_cache = _ParameterCache()
+# (object, number of parameter invalidations when it was received)
+_received = queue.Queue()
+_last_received_invalidations = None
+
+
+def _receive_thread_fn():
+    # The master sends parameter invalidations at any time. They are
+    # processed here immediately, and the other objects are passed to
+    # get_object.
+    while True:
+        try:
+            obj = _read_object()
+        except EOFError:
+            _received.put(None)
+            return
+        if (isinstance(obj, dict)
+                and obj.get("action") == "invalidate_parameter"):
+            _parameter_cache.invalidate(obj["name"])
+        else:
+            with _parameter_cache.lock:
+                _received.put((obj, _parameter_cache.invalidations))
+
+
 def get_object():
-    line = sys.__stdin__.readline()
-    return pyon.decode(line)
+    global _last_received_invalidations
+    r = _received.get()
+    if r is None:
+        raise EOFError
+    obj, _last_received_invalidations = r
+    return obj
+
+
+# objects are also sent by the thread of the realtime results buffer
+_put_lock = threading.Lock()
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    sys.__stdout__.write(ds)
-    sys.__stdout__.write("\n")
-    sys.__stdout__.flush()
+    with _put_lock:
+        _ipc_out.writelines(pyon.encode_binary(obj))
+        _ipc_out.flush()
 
 
 class ParentActionError(Exception):
@@ -30,6 +96,8 @@ def make_parent_action(action, argnames, exception=ParentActionError):
         request = {"action": action}
         for argname, arg in zip(argnames, args):
             request[argname] = arg
+        # the master processes the realtime results in order
+        _rt_results_buffer.flush()
         put_object(request)
         reply = get_object()
         if reply["status"] == "ok":
@@ -39,21 +107,137 @@ def make_parent_action(action, argnames, exception=ParentActionError):
     return parent_action
 
 
+def make_parent_notification(action, argnames):
+    """Returns a function that sends a notification to the master, which
+    processes it without replying. The function returns immediately.
+
+    """
+    argnames = argnames.split()
+    def parent_notification(*args):
+        notification = {"action": action, "reply": False}
+        for argname, arg in zip(argnames, args):
+            notification[argname] = arg
+        put_object(notification)
+    return parent_notification
+
+
 class ParentDDB:
     request = make_parent_action("req_device", "name", KeyError)
 
 
+_request_parameter = make_parent_action("req_parameter", "name", KeyError)
+_immutable_types = (type(None), bool, int, float, complex, str, bytes)
+# cached for parameters that are not in the database
+_absent = object()
+_not_cached = object()
+
+
+def request_parameter(name):
+    cache = _parameter_cache
+    with cache.lock:
+        value = cache.values.get(name, _not_cached)
+        if value is _not_cached:
+            cache.misses += 1
+        else:
+            cache.hits += 1
+    if value is _not_cached:
+        try:
+            value = _request_parameter(name)
+        except KeyError:
+            value = _absent
+        with cache.lock:
+            # Values changed after the reply was sent must not be cached.
+            if cache.invalidations == _last_received_invalidations:
+                cache.values[name] = value
+    if value is _absent:
+        raise KeyError(name)
+    if type(value) in _immutable_types:
+        return value
+    else:
+        # protect the cached value from modifications by the experiment
+        return deepcopy(value)
+
+
 class ParentPDB:
-    request = make_parent_action("req_parameter", "name", KeyError)
+    request = request_parameter
     set = make_parent_action("set_parameter", "name value")
 
 
-init_rt_results = make_parent_action("init_rt_results", "description")
-update_rt_results = make_parent_action("update_rt_results", "mod")
+init_rt_results = make_parent_action("init_rt_results", "rid description")
+update_rt_results = make_parent_notification("update_rt_results", "rid mod")
+finish_rt_results = make_parent_notification("finish_rt_results", "rid")
+
+
+class _RTResultsBuffer:
+    # The mods of the realtime results are coalesced and sent to the master
+    # in batches, at most period seconds after the first one, or once
+    # max_mods have been buffered. The mods are sent by a thread, so that
+    # the experiment does not wait for them, but also before any request
+    # to the master and at the end of the experiment.
+    def __init__(self, period=0.1, max_mods=10000):
+        self.period = period
+        self.max_mods = max_mods
+        # all attributes below are protected by the condition
+        self.cond = threading.Condition()
+        # RID of the experiment publishing the realtime results
+        self.rid = None
+        self.pending = []
+        self.count = 0
+        self.deadline = None
+
+    def add(self, mod):
+        if type(mod.get("x", mod.get("value"))) not in _immutable_types:
+            # the realtime results may be modified in place before the mod
+            # is sent
+            mod = deepcopy(mod)
+        with self.cond:
+            coalesce_mod(self.pending, mod)
+            self.count += 1
+            if self.count >= self.max_mods:
+                self._flush()
+            elif self.deadline is None:
+                self.deadline = monotonic() + self.period
+                self.cond.notify()
+
+    def _flush(self):
+        # with the condition held, so that batches are sent in order
+        if self.pending:
+            if len(self.pending) == 1:
+                update_rt_results(self.rid, self.pending[0])
+            else:
+                update_rt_results(self.rid,
+                                  {"action": "batch", "mods": self.pending})
+        self.pending = []
+        self.count = 0
+        self.deadline = None
+
+    def flush(self):
+        with self.cond:
+            self._flush()
+
+    def set_rid(self, rid):
+        with self.cond:
+            self._flush()
+            self.rid = rid
+
+    def thread_fn(self):
+        with self.cond:
+            while True:
+                if self.deadline is None:
+                    self.cond.wait()
+                else:
+                    timeout = self.deadline - monotonic()
+                    if timeout > 0:
+                        self.cond.wait(timeout)
+                    else:
+                        self._flush()
+
+
+_rt_results_buffer = _RTResultsBuffer()
 
 
 def publish_rt_results(notifier, data):
-    update_rt_results(data)
+    _rt_results_buffer.add(data)
 
 
 def get_unit(file, unit):
@@ -71,45 +255,145 @@ def get_unit(file, unit):
         return getattr(module, unit)
 
 
-def run(obj):
-    unit = get_unit(obj["file"], obj["unit"])
+class _Experiment:
+    # An experiment between the start of its prepare phase and the end of
+    # its analyze phase.
+    def __init__(self, rid, run_params, client_pool):
+        self.rid = rid
+        unit = get_unit(run_params["file"], run_params["unit"])
 
-    realtime_results = unit.realtime_results()
-    init_rt_results(realtime_results)
+        self.realtime_results = unit.realtime_results()
+        realtime_results_set = set()
+        for rr in self.realtime_results.keys():
+            if isinstance(rr, tuple):
+                for e in rr:
+                    realtime_results_set.add(e)
+            else:
+                realtime_results_set.add(rr)
+        self.rdb = ResultDB(realtime_results_set)
 
-    realtime_results_set = set()
-    for rr in realtime_results.keys():
-        if isinstance(rr, tuple):
-            for e in rr:
-                realtime_results_set.add(e)
-        else:
-            realtime_results_set.add(rr)
-    rdb = ResultDB(realtime_results_set)
-    rdb.realtime_data.publish = publish_rt_results
+        self.dbh = DBHub(ParentDDB, ParentPDB, self.rdb, client_pool)
+        try:
+            self.unit_inst = unit(self.dbh, **run_params["arguments"])
+        except:
+            self.dbh.close()
+            raise
+
+    def prepare(self):
+        if hasattr(self.unit_inst, "prepare"):
+            self.unit_inst.prepare()
 
-    dbh = DBHub(ParentDDB, ParentPDB, rdb)
-    try:
+    def run(self):
+        # The realtime results are only published during the run phase,
+        # in the group of the experiment, which the master keeps until
+        # another group is initialized after this phase.
+        if not self.realtime_results:
+            self.unit_inst.run()
+            return
+        init_rt_results(self.rid, self.realtime_results)
+        _rt_results_buffer.set_rid(self.rid)
+        realtime_data = self.rdb.realtime_data
+        for name, value in realtime_data.read.items():
+            if value:
+                publish_rt_results(realtime_data,
+                                   {"action": "setitem", "path": [],
+                                    "key": name, "value": value})
+        realtime_data.publish = publish_rt_results
         try:
-            unit_inst = unit(dbh, **obj["arguments"])
-            unit_inst.run()
-        except Exception:
-            put_object({"action": "report_completed",
-                        "status": "failed",
-                        "message": traceback.format_exc()})
-        else:
-            put_object({"action": "report_completed",
-                        "status": "ok"})
-    finally:
-        dbh.close()
+            self.unit_inst.run()
+        finally:
+            _rt_results_buffer.flush()
+            realtime_data.publish = None
+            finish_rt_results(self.rid)
+
+    def analyze(self):
+        if hasattr(self.unit_inst, "analyze"):
+            self.unit_inst.analyze()
+
+    def close(self):
+        self.dbh.close()
+
+
+def report_completed(status, message=None):
+    _rt_results_buffer.flush()
+    obj = {"action": "report_completed",
+           "status": status,
+           "parameter_cache": get_parameter_cache_stats()}
+    if message is not None:
+        obj["message"] = message
+    put_object(obj)
+
+
+def get_parameter_cache_stats():
+    """Returns the numbers of parameter requests served from the cache
+    (hits) and from the master (misses) since the last call, and resets
+    them.
+
+    """
+    cache = _parameter_cache
+    with cache.lock:
+        r = {"hits": cache.hits, "misses": cache.misses}
+        cache.hits = cache.misses = 0
+    return r
+
+
+# imported before the worker reports that it is ready, so that the
+# scheduler can keep a spare worker in which they are already loaded
+_preloaded_modules = [
+    "numpy",
+    "artiq.coredevice.core",
+    # initializes LLVM
+    "artiq.coredevice.runtime"
+]
+
+
+def preload_modules():
+    for name in _preloaded_modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
 
 
 def main():
-    sys.stdout = sys.stderr
+    global _ipc_in, _ipc_out
+    _ipc_in = open(int(sys.argv[1]), "rb")
+    _ipc_out = open(int(sys.argv[2]), "wb")
 
+    threading.Thread(target=_receive_thread_fn, daemon=True).start()
+    threading.Thread(target=_rt_results_buffer.thread_fn,
+                     daemon=True).start()
+    preload_modules()
+    put_object("ready")
+    # keep controller connections open across runs
+    client_pool = ClientPool()
+    experiment = None
     while True:
         obj = get_object()
         put_object("ack")
-        run(obj)
+        action = obj["action"]
+        try:
+            if action == "prepare":
+                experiment = _Experiment(obj["rid"], obj["run_params"],
+                                         client_pool)
+                experiment.prepare()
+            elif action == "run":
+                experiment.run()
+            elif action == "analyze":
+                experiment.analyze()
+            else:
+                raise ValueError("Unknown action: " + action)
+        except Exception:
+            # the remaining phases of the experiment are not executed
+            if experiment is not None:
+                experiment.close()
+                experiment = None
+            report_completed("failed", traceback.format_exc())
+        else:
+            if action == "analyze":
+                experiment.close()
+                experiment = None
+            report_completed("ok")
 
 if __name__ == "__main__":
     main()
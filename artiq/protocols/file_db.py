@@ -1,11 +1,62 @@
-from time import time
+import os
+import threading
+import logging
+import struct
+import mmap
+from bisect import bisect_left, bisect_right
+from time import time, monotonic
 
 from artiq.protocols import pyon
-from artiq.protocols.sync_struct import Notifier
+from artiq.protocols.sync_struct import Notifier, process_mod
+
+
+logger = logging.getLogger(__name__)
+
+
+def _store_file_atomic(filename, x, fsync):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        pyon.dump(x, f, True)
+        f.write("\n")
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
 
 
 class FlatFileDB:
-    def __init__(self, filename, default_data=None):
+    """A dictionary stored in a PYON file and encapsulated in a
+    ``Notifier``.
+
+    By default, the whole file is rewritten on every change. If ``journal``
+    is set, changes are instead appended to a journal file (the name of the
+    main file followed by ``.journal``), which is merged into the main file
+    (*compacted*) once it contains ``journal_limit`` changes, and when the
+    database is loaded. Changes in the journal are applied again when
+    loading, so none is lost if the process is interrupted before a
+    compaction. A change that was being written when the process was
+    interrupted is ignored. The main file is replaced atomically.
+
+    If ``save_delay`` is set instead, the file is not rewritten during
+    the change but by a background thread, once no change has been made
+    for ``save_delay`` seconds (and at most ``10*save_delay`` seconds after
+    the first unsaved change). The file is replaced atomically. Call
+    ``flush`` to wait for the pending changes to be written, e.g. before
+    exiting. ``journal`` and ``save_delay`` cannot be used together.
+
+    :param fsync: When to wait for the data to reach the disk:
+        ``"always"`` after each change (safest and slowest), ``"compact"``
+        after each compaction or background save, or ``"never"`` (leave it
+        to the operating system). Not used when the file is rewritten
+        synchronously.
+
+    """
+    def __init__(self, filename, default_data=None, journal=False,
+                 journal_limit=1000, fsync="compact", save_delay=None):
+        if fsync not in ("always", "compact", "never"):
+            raise ValueError("Unknown fsync policy: " + fsync)
+        if journal and save_delay is not None:
+            raise ValueError("Journal and save delay are exclusive")
         self.filename = filename
         try:
             data = pyon.load_file(self.filename)
@@ -17,22 +68,148 @@ class FlatFileDB:
         self.data = Notifier(data)
         self.hooks = []
 
+        self.journal = journal
+        self.journal_limit = journal_limit
+        self.fsync = fsync
+        if journal:
+            self._journal_filename = filename + ".journal"
+            if self._replay_journal():
+                self.compact()
+            self._journal_file = open(self._journal_filename, "a")
+            self._journal_length = 0
+
+        self.save_delay = save_delay
+        if save_delay is not None:
+            self._save_cond = threading.Condition()
+            self._unsaved = None
+            self._save_deadline = None
+            self._save_limit = None
+            self._saving = False
+            self._save_thread = threading.Thread(target=self._save_thread_fn,
+                                                 daemon=True)
+            self._save_thread.start()
+
+    def _replay_journal(self):
+        try:
+            f = open(self._journal_filename, "r")
+        except FileNotFoundError:
+            return False
+        with f:
+            lines = f.read().split("\n")
+        # lines[-1] is empty unless the last change was being written
+        for line in lines[:-1]:
+            mod = pyon.decode(line)
+            try:
+                process_mod(self.data.read, mod)
+            except KeyError:
+                # deletion already in the main file before an interrupted
+                # compaction
+                pass
+        return len(lines) > 1 or lines[0] != ""
+
+    def _write_journal(self, mod):
+        self._journal_file.write(pyon.encode(mod) + "\n")
+        self._journal_file.flush()
+        if self.fsync == "always":
+            os.fsync(self._journal_file.fileno())
+        self._journal_length += 1
+        if self._journal_length >= self.journal_limit:
+            self.compact()
+
+    def compact(self):
+        """Writes the data into the main file and empties the journal.
+
+        """
+        _store_file_atomic(self.filename, self.data.read,
+                           self.fsync != "never")
+        with open(self._journal_filename, "w"):
+            pass
+        self._journal_length = 0
+
+    def _save_thread_fn(self):
+        while True:
+            with self._save_cond:
+                while (self._unsaved is None
+                       or monotonic() < self._save_deadline):
+                    if self._unsaved is None:
+                        self._save_cond.wait()
+                    else:
+                        self._save_cond.wait(self._save_deadline
+                                             - monotonic())
+                data = self._unsaved
+                self._unsaved = None
+                self._saving = True
+            try:
+                _store_file_atomic(self.filename, data,
+                                   self.fsync != "never")
+            except Exception:
+                logger.error("failed to save %s", self.filename,
+                             exc_info=True)
+            finally:
+                with self._save_cond:
+                    self._saving = False
+                    self._save_cond.notify_all()
+
+    def flush(self):
+        """Waits until all changes are written to the file.
+
+        """
+        if self.save_delay is not None:
+            with self._save_cond:
+                if self._unsaved is not None:
+                    self._save_deadline = monotonic()
+                    self._save_cond.notify_all()
+                while self._unsaved is not None or self._saving:
+                    self._save_cond.wait()
+
+    def close(self):
+        """Writes all changes to the file. With ``journal``, compacts it
+        and closes it. The database must not be modified afterwards.
+
+        """
+        if self.journal:
+            self._journal_file.close()
+            self.compact()
+        else:
+            self.flush()
+
     def save(self):
-        pyon.store_file(self.filename, self.data.read)
+        if self.save_delay is None:
+            pyon.store_file(self.filename, self.data.read)
+            return
+        # Values are replaced and not modified in place, so a shallow copy
+        # is enough for the background thread.
+        data = dict(self.data.read)
+        now = monotonic()
+        with self._save_cond:
+            if self._unsaved is None:
+                self._save_limit = now + 10*self.save_delay
+            self._unsaved = data
+            self._save_deadline = min(now + self.save_delay,
+                                      self._save_limit)
+            self._save_cond.notify_all()
 
     def request(self, name):
         return self.data.read[name]
 
     def set(self, name, value):
         self.data[name] = value
-        self.save()
+        if self.journal:
+            self._write_journal({"action": "setitem", "path": [],
+                                 "key": name, "value": value})
+        else:
+            self.save()
         timestamp = time()
         for hook in self.hooks:
             hook.set(timestamp, name, value)
 
     def delete(self, name):
         del self.data[name]
-        self.save()
+        if self.journal:
+            self._write_journal({"action": "delitem", "path": [],
+                                 "key": name})
+        else:
+            self.save()
         timestamp = time()
         for hook in self.hooks:
             hook.delete(timestamp, name)
@@ -52,3 +229,147 @@ class SimpleHistory:
         if len(self.history.read) >= self.depth:
             del self.history[0]
         self.history.append((timestamp, name))
+
+
+# timestamp, length of name, length of value (_deleted for deletions)
+_history_header = struct.Struct("<dHI")
+_deleted = 0xffffffff
+
+
+class PersistentHistory:
+    """Records the changes made to a ``FlatFileDB`` in a file, when used as
+    one of its hooks, and answers queries about the history of values.
+
+    Each change is appended to the file as a record made of a header (the
+    timestamp and the lengths of the name and of the value) followed by
+    the name and the PYON-encoded value. An index of the timestamps and
+    file offsets of the records of each name is built from the headers when
+    the file is opened, without decoding the values, and values are read
+    from the file when they are requested.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # name -> ([timestamps], [offsets of records])
+        self._index = dict()
+        self._file = open(filename, "a+b")
+        self._file.seek(0)
+        end = self._build_index()
+        self._file.truncate(end)
+
+    def _build_index(self):
+        # Returns the offset of the end of the last complete record.
+        size = os.fstat(self._file.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(self._file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + _history_header.size <= size:
+                timestamp, name_len, value_len = \
+                    _history_header.unpack_from(data, offset)
+                name_start = offset + _history_header.size
+                end = name_start + name_len
+                if value_len != _deleted:
+                    end += value_len
+                if end > size:
+                    break
+                name = data[name_start:name_start + name_len].decode()
+                self._add_to_index(name, timestamp, offset)
+                offset = end
+        # anything after offset was interrupted while being written
+        return offset
+
+    def _add_to_index(self, name, timestamp, offset):
+        try:
+            timestamps, offsets = self._index[name]
+        except KeyError:
+            timestamps, offsets = self._index[name] = [], []
+        if not timestamps or timestamp >= timestamps[-1]:
+            timestamps.append(timestamp)
+            offsets.append(offset)
+        else:
+            # the clock has gone backwards
+            i = bisect_right(timestamps, timestamp)
+            timestamps.insert(i, timestamp)
+            offsets.insert(i, offset)
+
+    def _append(self, timestamp, name, value):
+        name_b = name.encode()
+        if value is None:
+            value_b = b""
+            header = _history_header.pack(timestamp, len(name_b), _deleted)
+        else:
+            value_b = pyon.encode(value[0]).encode()
+            header = _history_header.pack(timestamp, len(name_b),
+                                          len(value_b))
+        f = self._file
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(header + name_b + value_b)
+        f.flush()
+        self._add_to_index(name, timestamp, offset)
+
+    def _read(self, offset):
+        # Returns (timestamp, value) or (timestamp, ) for deletions.
+        f = self._file
+        f.seek(offset)
+        timestamp, name_len, value_len = _history_header.unpack(
+            f.read(_history_header.size))
+        f.seek(name_len, os.SEEK_CUR)
+        if value_len == _deleted:
+            return (timestamp, )
+        else:
+            return timestamp, pyon.decode(f.read(value_len).decode())
+
+    def set(self, timestamp, name, value):
+        self._append(timestamp, name, (value, ))
+
+    def delete(self, timestamp, name):
+        self._append(timestamp, name, None)
+
+    def close(self):
+        self._file.close()
+
+    def get_names(self):
+        """Returns the list of names that have a recorded history.
+
+        """
+        return sorted(self._index.keys())
+
+    def get(self, name, timestamp=None):
+        """Returns the value that ``name`` had at the given time (by
+        default, the current time).
+
+        Raises ``KeyError`` if there was no value at that time.
+
+        """
+        try:
+            timestamps, offsets = self._index[name]
+        except KeyError:
+            raise KeyError(name)
+        if timestamp is None:
+            i = len(timestamps)
+        else:
+            i = bisect_right(timestamps, timestamp)
+        if not i:
+            raise KeyError(name)
+        record = self._read(offsets[i - 1])
+        if len(record) == 1:
+            raise KeyError(name)
+        return record[1]
+
+    def get_changes(self, name, start=None, end=None):
+        """Returns the changes of ``name`` with a timestamp between
+        ``start`` and ``end`` (inclusive, ``None`` for no limit), in
+        chronological order. Changes are given as ``(timestamp, value)``
+        tuples, and deletions as ``(timestamp, )`` tuples.
+
+        """
+        try:
+            timestamps, offsets = self._index[name]
+        except KeyError:
+            return []
+        i = 0 if start is None else bisect_left(timestamps, start)
+        j = len(timestamps) if end is None else bisect_right(timestamps, end)
+        return [self._read(offset) for offset in offsets[i:j]]
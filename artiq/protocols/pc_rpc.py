@@ -10,11 +10,17 @@ client passes a list as a parameter of an RPC method, and that method
 ``append()s`` an element to the list, the element is not appended to the
 client's list.
 
+Messages are exchanged in binary PYON when both the client and the server
+support it, which avoids the cost of base64 encoding for large Numpy
+arrays. Otherwise, the text format is used.
+
 """
 
 import socket
 import asyncio
 import traceback
+import time
+from functools import partial
 
 from artiq.protocols import pyon
 from artiq.protocols.asyncio_server import AsyncioServer as _AsyncioServer
@@ -37,6 +43,90 @@ class IncompatibleServer(Exception):
 
 
 _init_string = b"ARTIQ pc_rpc\n"
+_binary_encoding = "pyon_binary"
+_recv_chunk_size = 65536
+
+
+def _sendmsg_all(sock, buffers):
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            del buffers[0]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+@asyncio.coroutine
+def _read_obj(reader, binary):
+    # Returns None at end of stream. All protocol messages are dicts.
+    if binary:
+        try:
+            header = yield from reader.readexactly(pyon.binary_header_size)
+            payload = yield from reader.readexactly(
+                pyon.decode_binary_header(header))
+        except asyncio.IncompleteReadError:
+            return None
+        return pyon.decode_binary(payload)
+    else:
+        line = yield from reader.readline()
+        if not line:
+            return None
+        return pyon.decode(line.decode())
+
+
+def _write_obj(writer, obj, binary):
+    if binary:
+        writer.writelines(pyon.encode_binary(obj))
+    else:
+        line = pyon.encode(obj) + "\n"
+        writer.write(line.encode())
+
+
+def _reply_value(obj):
+    if obj["status"] == "ok":
+        return obj["ret"]
+    elif obj["status"] == "failed":
+        raise RemoteError(obj["message"])
+    else:
+        raise ValueError
+
+
+def _batch_results(replies):
+    results = []
+    for reply in replies:
+        try:
+            results.append(_reply_value(reply))
+        except RemoteError as e:
+            results.append(e)
+    return results
+
+
+class _Batch:
+    def __init__(self, execute):
+        self.__execute = execute
+        self.__calls = []
+        self.__results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.__results = self.__execute(self.__calls)
+
+    def get_rpc_results(self):
+        return self.__results
+
+    def __getattr__(self, name):
+        def proxy(*args, **kwargs):
+            self.__calls.append({"name": name,
+                                 "args": args, "kwargs": kwargs})
+        return proxy
 
 
 class Client:
@@ -54,6 +144,8 @@ class Client:
     Only methods are supported. Attributes must be accessed by providing and
     using "get" and/or "set" methods on the server side.
 
+    Several calls can be sent in a single message using ``batch_rpc``.
+
     At object initialization, the connection to the remote server is
     automatically attempted. The user must call ``close_rpc`` to
     free resources properly after initialization completes successfully.
@@ -67,10 +159,21 @@ class Client:
         Use ``None`` to skip selecting a target. The list of targets can then
         be retrieved using ``get_rpc_id`` and then one can be selected later
         using ``select_rpc_target``.
+    :param binary: Use binary PYON if the server supports it.
+    :param timeout: Timeout in seconds for connecting and for each socket
+        operation, or ``None`` to wait forever. When a timeout occurs,
+        ``socket.timeout`` is raised and the client must be closed.
+    :param max_message_size: Maximum size in bytes of messages accepted
+        from the server, or ``None`` for no limit. ``ValueError`` is raised
+        when a message exceeds it, and the client must then be closed.
 
     """
-    def __init__(self, host, port, target_name):
-        self.__socket = socket.create_connection((host, port))
+    def __init__(self, host, port, target_name, binary=True,
+                 timeout=None, max_message_size=None):
+        self.__socket = socket.create_connection((host, port), timeout)
+        self.__buffer = bytearray()
+        self.__max_message_size = max_message_size
+        self.__binary = False
 
         try:
             self.__socket.sendall(_init_string)
@@ -78,6 +181,9 @@ class Client:
             server_identification = self.__recv()
             self.__target_names = server_identification["targets"]
             self.__id_parameters = server_identification["parameters"]
+            self.__binary_supported = binary and _binary_encoding in \
+                server_identification.get("encodings", [])
+            self.__batch_supported = server_identification.get("batch", False)
             if target_name is not None:
                 self.select_rpc_target(target_name)
         except:
@@ -91,7 +197,12 @@ class Client:
         """
         if target_name not in self.__target_names:
             raise IncompatibleServer
-        self.__socket.sendall((target_name + "\n").encode())
+        if self.__binary_supported:
+            line = target_name + " " + _binary_encoding + "\n"
+            self.__socket.sendall(line.encode())
+            self.__binary = True
+        else:
+            self.__socket.sendall((target_name + "\n").encode())
 
     def get_rpc_id(self):
         """Returns a tuple (target_names, id_parameters) containing the
@@ -108,30 +219,123 @@ class Client:
         """
         self.__socket.close()
 
+    def is_rpc_connected(self):
+        """Returns ``False`` if the connection has been closed or reset by
+        the server, e.g. because it was restarted. This does not block and
+        does not exchange data with the server.
+
+        """
+        timeout = self.__socket.gettimeout()
+        self.__socket.setblocking(False)
+        try:
+            # the server never sends data without a request
+            return self.__socket.recv(1, socket.MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.__socket.settimeout(timeout)
+
     def __send(self, obj):
-        line = pyon.encode(obj) + "\n"
-        self.__socket.sendall(line.encode())
+        if self.__binary:
+            _sendmsg_all(self.__socket, pyon.encode_binary(obj))
+        else:
+            line = pyon.encode(obj) + "\n"
+            self.__socket.sendall(line.encode())
+
+    def __recv_more(self):
+        data = self.__socket.recv(_recv_chunk_size)
+        if not data:
+            raise ConnectionResetError("Connection closed by server")
+        self.__buffer += data
+
+    def __check_size(self, n):
+        if (self.__max_message_size is not None
+                and n > self.__max_message_size):
+            raise ValueError("Message from server exceeds maximum size")
+
+    def __recv_exactly(self, n):
+        self.__check_size(n)
+        buf = self.__buffer
+        if len(buf) >= n:
+            r = buf[:n]
+            del buf[:n]
+            return r
+        # receive the rest directly into the result, without extra copies
+        r = bytearray(n)
+        pos = len(buf)
+        r[:pos] = buf
+        buf.clear()
+        view = memoryview(r)
+        while pos < n:
+            received = self.__socket.recv_into(view[pos:])
+            if not received:
+                raise ConnectionResetError("Connection closed by server")
+            pos += received
+        return r
+
+    def __recv_line(self):
+        buf = self.__buffer
+        start = 0
+        while True:
+            i = buf.find(b"\n", start)
+            if i >= 0:
+                break
+            # only search the new data next time
+            start = len(buf)
+            self.__check_size(start)
+            self.__recv_more()
+        line = buf[:i]
+        del buf[:i+1]
+        return line
 
     def __recv(self):
-        buf = self.__socket.recv(4096).decode()
-        while "\n" not in buf:
-            more = self.__socket.recv(4096)
-            if not more:
-                break
-            buf += more.decode()
-        return pyon.decode(buf)
+        if self.__binary:
+            header = self.__recv_exactly(pyon.binary_header_size)
+            payload = self.__recv_exactly(pyon.decode_binary_header(header))
+            return pyon.decode_binary(payload)
+        else:
+            return pyon.decode(self.__recv_line().decode())
 
     def __do_rpc(self, name, args, kwargs):
         obj = {"action": "call", "name": name, "args": args, "kwargs": kwargs}
         self.__send(obj)
 
         obj = self.__recv()
-        if obj["status"] == "ok":
-            return obj["ret"]
-        elif obj["status"] == "failed":
-            raise RemoteError(obj["message"])
+        return _reply_value(obj)
+
+    def __do_batch(self, calls):
+        if self.__batch_supported:
+            self.__send({"action": "call_batch", "calls": calls})
+            replies = _reply_value(self.__recv())
         else:
-            raise ValueError
+            replies = []
+            for call in calls:
+                call["action"] = "call"
+                self.__send(call)
+                replies.append(self.__recv())
+        return _batch_results(replies)
+
+    def batch_rpc(self):
+        """Returns a context manager that collects method calls and sends
+        them to the server in a single message when the ``with`` block is
+        exited. The server executes the calls in order. ::
+
+            with c.batch_rpc() as batch:
+                batch.foo(1)
+                batch.bar(2)
+            foo_result, bar_result = batch.get_rpc_results()
+
+        Each element of the list returned by ``get_rpc_results`` is either the
+        value returned by the corresponding method, or a ``RemoteError``
+        instance if that call failed. A failed call does not prevent the
+        following ones from being executed.
+
+        If the ``with`` block raises an exception, no call is made.
+
+        """
+        return _Batch(self.__do_batch)
 
     def __getattr__(self, name):
         def proxy(*args, **kwargs):
@@ -139,12 +343,132 @@ class Client:
         return proxy
 
 
+class _PooledClient:
+    def __init__(self, pool, host, port, target_name):
+        self.__pool = pool
+        self.__address = host, port, target_name
+        self.__client = None
+
+    def __get_client(self):
+        if self.__client is not None and not self.__client.is_rpc_connected():
+            self.close_rpc()
+        if self.__client is None:
+            self.__client = self.__pool._connect(*self.__address)
+        return self.__client
+
+    def get_rpc_id(self):
+        return self.__get_client().get_rpc_id()
+
+    def is_rpc_connected(self):
+        return self.__client is not None and self.__client.is_rpc_connected()
+
+    def close_rpc(self):
+        if self.__client is not None:
+            self.__client.close_rpc()
+            self.__client = None
+
+    def __do_batch(self, calls):
+        client = self.__get_client()
+        try:
+            with client.batch_rpc() as batch:
+                for call in calls:
+                    getattr(batch, call["name"])(*call["args"],
+                                                 **call["kwargs"])
+            return batch.get_rpc_results()
+        except (OSError, ValueError):
+            self.close_rpc()
+            raise
+
+    def batch_rpc(self):
+        return _Batch(self.__do_batch)
+
+    def __getattr__(self, name):
+        def proxy(*args, **kwargs):
+            client = self.__get_client()
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            except (OSError, ValueError):
+                # connection lost or out of sync
+                self.close_rpc()
+                raise
+        return proxy
+
+
+class ClientPool:
+    """Keeps connections to RPC servers open so that they can be reused,
+    e.g. by the successive experiments run by a worker process, without
+    repeating the connection and target selection.
+
+    The objects returned by ``get`` behave like ``Client`` objects, except
+    that they connect on first use, and that a connection closed by the
+    server (e.g. because the controller was restarted) is detected and
+    re-established before the next call. If the connection is lost during a
+    call, that call raises the corresponding exception and is not retried,
+    as the server may have already executed it.
+
+    Connection attempts are retried with exponential backoff.
+
+    This class is not thread-safe.
+
+    :param retry_timeout: Time after which failed connection attempts are
+        no longer retried and the last error is raised.
+    :param backoff_initial: Delay before the first retry.
+    :param backoff_max: Maximum delay between retries.
+
+    """
+    def __init__(self, retry_timeout=10.0, backoff_initial=0.1,
+                 backoff_max=2.0):
+        self.retry_timeout = retry_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self._clients = dict()
+
+    def get(self, host, port, target_name):
+        """Returns the client for the given server and target. The same
+        object is returned for the same parameters, so it should not be
+        used concurrently from several threads.
+
+        See ``Client`` for a description of the parameters.
+
+        """
+        key = host, port, target_name
+        try:
+            return self._clients[key]
+        except KeyError:
+            client = _PooledClient(self, host, port, target_name)
+            self._clients[key] = client
+            return client
+
+    def close(self):
+        """Closes all connections. The pool can still be used afterwards."""
+        for client in self._clients.values():
+            client.close_rpc()
+
+    def _connect(self, host, port, target_name):
+        deadline = time.monotonic() + self.retry_timeout
+        backoff = self.backoff_initial
+        while True:
+            try:
+                return Client(host, port, target_name)
+            except OSError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise
+                time.sleep(min(backoff, remaining))
+                backoff = min(2*backoff, self.backoff_max)
+
+
 class AsyncioClient:
     """This class is similar to :class:`artiq.protocols.pc_rpc.Client`, but
     uses ``asyncio`` instead of blocking calls.
 
     All RPC methods are coroutines.
 
+    If the server supports it, several calls can be in progress at the same
+    time on one connection (e.g. from different tasks). Calls are then
+    tagged with an identifier, and the server replies to calls to coroutine
+    methods as soon as they complete, not necessarily in order.
+
     """
     def __init__(self):
         self.__lock = asyncio.Lock()
@@ -152,9 +476,16 @@ class AsyncioClient:
         self.__writer = None
         self.__target_names = None
         self.__id_parameters = None
+        self.__binary_supported = False
+        self.__binary = False
+        self.__pipelining_supported = False
+        self.__batch_supported = False
+        self.__receive_task = None
+        self.__next_call_id = 0
+        self.__pending_calls = dict()
 
     @asyncio.coroutine
-    def connect_rpc(self, host, port, target_name):
+    def connect_rpc(self, host, port, target_name, binary=True):
         """Connects to the server. This cannot be done in __init__ because
         this method is a coroutine. See ``Client`` for a description of the
         parameters.
@@ -167,6 +498,11 @@ class AsyncioClient:
             server_identification = yield from self.__recv()
             self.__target_names = server_identification["targets"]
             self.__id_parameters = server_identification["parameters"]
+            self.__binary_supported = binary and _binary_encoding in \
+                server_identification.get("encodings", [])
+            self.__pipelining_supported = \
+                server_identification.get("pipelining", False)
+            self.__batch_supported = server_identification.get("batch", False)
             if target_name is not None:
                 self.select_rpc_target(target_name)
         except:
@@ -180,7 +516,14 @@ class AsyncioClient:
         """
         if target_name not in self.__target_names:
             raise IncompatibleServer
-        self.__writer.write((target_name + "\n").encode())
+        if self.__binary_supported:
+            line = target_name + " " + _binary_encoding + "\n"
+            self.__writer.write(line.encode())
+            self.__binary = True
+        else:
+            self.__writer.write((target_name + "\n").encode())
+        if self.__pipelining_supported:
+            self.__receive_task = asyncio.Task(self.__receive_cr())
 
     def get_rpc_id(self):
         """Returns a tuple (target_names, id_parameters) containing the
@@ -193,40 +536,110 @@ class AsyncioClient:
         """Closes the connection to the RPC server.
 
         No further method calls should be done after this method is called.
+        Calls still in progress raise ``ConnectionResetError``.
 
         """
+        if self.__receive_task is not None:
+            self.__receive_task.cancel()
+            self.__receive_task = None
+        self.__fail_pending_calls(
+            ConnectionResetError("Connection closed by client"))
         self.__writer.close()
         self.__reader = None
         self.__writer = None
         self.__target_names = None
         self.__id_parameters = None
+        self.__binary_supported = False
+        self.__binary = False
+        self.__pipelining_supported = False
 
     def __send(self, obj):
-        line = pyon.encode(obj) + "\n"
-        self.__writer.write(line.encode())
+        _write_obj(self.__writer, obj, self.__binary)
 
     @asyncio.coroutine
     def __recv(self):
-        line = yield from self.__reader.readline()
-        return pyon.decode(line.decode())
+        obj = yield from _read_obj(self.__reader, self.__binary)
+        if obj is None:
+            raise ConnectionResetError("Connection closed by server")
+        return obj
+
+    def __fail_pending_calls(self, exception):
+        for future in self.__pending_calls.values():
+            if not future.done():
+                future.set_exception(exception)
+        self.__pending_calls.clear()
 
     @asyncio.coroutine
-    def __do_rpc(self, name, args, kwargs):
-        yield from self.__lock.acquire()
+    def __receive_cr(self):
         try:
-            obj = {"action": "call", "name": name,
-                   "args": args, "kwargs": kwargs}
-            self.__send(obj)
-
-            obj = yield from self.__recv()
-            if obj["status"] == "ok":
-                return obj["ret"]
-            elif obj["status"] == "failed":
-                raise RemoteError(obj["message"])
-            else:
-                raise ValueError
-        finally:
-            self.__lock.release()
+            while True:
+                obj = yield from self.__recv()
+                future = self.__pending_calls.pop(obj["id"])
+                # the caller may have been cancelled
+                if not future.done():
+                    future.set_result(obj)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.__fail_pending_calls(e)
+
+    @asyncio.coroutine
+    def __do_pipelined_rpc(self, obj):
+        if self.__receive_task.done():
+            raise ConnectionResetError("Connection to server lost")
+        call_id = self.__next_call_id
+        self.__next_call_id += 1
+        obj["id"] = call_id
+        future = asyncio.Future()
+        self.__pending_calls[call_id] = future
+        self.__send(obj)
+        return (yield from future)
+
+    @asyncio.coroutine
+    def __do_request(self, obj):
+        if self.__receive_task is not None:
+            return (yield from self.__do_pipelined_rpc(obj))
+        else:
+            yield from self.__lock.acquire()
+            try:
+                self.__send(obj)
+                return (yield from self.__recv())
+            finally:
+                self.__lock.release()
+
+    @asyncio.coroutine
+    def __do_rpc(self, name, args, kwargs):
+        obj = {"action": "call", "name": name,
+               "args": args, "kwargs": kwargs}
+        obj = yield from self.__do_request(obj)
+        return _reply_value(obj)
+
+    @asyncio.coroutine
+    def __do_batch(self, calls):
+        if self.__batch_supported:
+            obj = yield from self.__do_request(
+                {"action": "call_batch", "calls": calls})
+            replies = _reply_value(obj)
+        else:
+            replies = []
+            for call in calls:
+                call["action"] = "call"
+                obj = yield from self.__do_request(call)
+                replies.append(obj)
+        return _batch_results(replies)
+
+    def batch_rpc(self):
+        """Same as ``Client.batch_rpc``, except that ``get_rpc_results``
+        returns a future. The calls are sent when the ``with`` block
+        is exited. ::
+
+            with c.batch_rpc() as batch:
+                batch.foo(1)
+                batch.bar(2)
+            foo_result, bar_result = yield from batch.get_rpc_results()
+
+        """
+        return _Batch(lambda calls: asyncio.Task(self.__do_batch(calls)))
 
     def __getattr__(self, name):
         @asyncio.coroutine
@@ -251,11 +664,28 @@ class Server(_AsyncioServer):
     :param id_parameters: An optional human-readable string giving more
         information about the parameters of the server.
 
+    Target methods may be coroutines. Calls to them from clients that
+    support pipelining are run concurrently, and other calls on the same
+    connection are processed in the meantime. Batches of calls are always
+    executed in order, one call after the other.
+
+    Other methods are run in the event loop thread by default, and block
+    all connections while they execute. If they may block (e.g. on
+    hardware I/O), an executor can be given to run them instead. The server
+    still ensures that only one such method runs at a time for a given
+    target, so that drivers do not need to be thread-safe.
+
+    :param executor: An optional ``concurrent.futures.Executor`` (typically
+        a ``ThreadPoolExecutor``) used to run methods that are not
+        coroutines.
+
     """
-    def __init__(self, targets, id_parameters=None):
+    def __init__(self, targets, id_parameters=None, executor=None):
         _AsyncioServer.__init__(self)
         self.targets = targets
         self.id_parameters = id_parameters
+        self.executor = executor
+        self._target_locks = {name: asyncio.Lock() for name in targets}
 
     @asyncio.coroutine
     def _handle_connection_cr(self, reader, writer):
@@ -266,38 +696,119 @@ class Server(_AsyncioServer):
 
             obj = {
                 "targets": sorted(self.targets.keys()),
-                "parameters": self.id_parameters
+                "parameters": self.id_parameters,
+                "encodings": [_binary_encoding],
+                "pipelining": True,
+                "batch": True
             }
-            line = pyon.encode(obj) + "\n"
-            writer.write(line.encode())
+            _write_obj(writer, obj, False)
             line = yield from reader.readline()
             if not line:
                 return
-            target_name = line.decode()[:-1]
+            target_name, _, encoding = line.decode()[:-1].partition(" ")
+            if encoding == _binary_encoding:
+                binary = True
+            elif not encoding:
+                binary = False
+            else:
+                return
             try:
                 target = self.targets[target_name]
             except KeyError:
                 return
 
-            while True:
-                line = yield from reader.readline()
-                if not line:
-                    break
-                obj = pyon.decode(line.decode())
-                try:
-                    method = getattr(target, obj["name"])
-                    ret = method(*obj["args"], **obj["kwargs"])
-                    obj = {"status": "ok", "ret": ret}
-                except Exception:
-                    obj = {"status": "failed",
-                           "message": traceback.format_exc()}
-                line = pyon.encode(obj) + "\n"
-                writer.write(line.encode())
+            call_tasks = set()
+            try:
+                while True:
+                    obj = yield from _read_obj(reader, binary)
+                    if obj is None:
+                        break
+                    if obj["action"] == "call_batch":
+                        reply = yield from self._process_batch(
+                            target_name, target, obj["calls"])
+                        if "id" in obj:
+                            reply["id"] = obj["id"]
+                        _write_obj(writer, reply, binary)
+                        continue
+                    try:
+                        ret = self._call(target_name, target, obj)
+                    except Exception:
+                        ret = None
+                        reply = {"status": "failed",
+                                 "message": traceback.format_exc()}
+                    else:
+                        reply = {"status": "ok", "ret": ret}
+                    if asyncio.iscoroutine(ret):
+                        if "id" in obj:
+                            task = asyncio.Task(self._finish_call(
+                                writer, binary, obj["id"], ret))
+                            call_tasks.add(task)
+                            task.add_done_callback(call_tasks.discard)
+                            continue
+                        reply = yield from self._await_call(ret)
+                    if "id" in obj:
+                        reply["id"] = obj["id"]
+                    _write_obj(writer, reply, binary)
+            finally:
+                for task in list(call_tasks):
+                    task.cancel()
         finally:
             writer.close()
 
+    @asyncio.coroutine
+    def _call_in_executor(self, target_name, method, args, kwargs):
+        lock = self._target_locks[target_name]
+        yield from lock.acquire()
+        try:
+            return (yield from asyncio.get_event_loop().run_in_executor(
+                self.executor, partial(method, *args, **kwargs)))
+        finally:
+            lock.release()
+
+    def _call(self, target_name, target, call):
+        # Returns either the value returned by the method, or a coroutine
+        # that must be waited for to obtain it.
+        method = getattr(target, call["name"])
+        if (self.executor is not None
+                and not asyncio.iscoroutinefunction(method)):
+            return self._call_in_executor(target_name, method,
+                                          call["args"], call["kwargs"])
+        else:
+            return method(*call["args"], **call["kwargs"])
+
+    @asyncio.coroutine
+    def _process_batch(self, target_name, target, calls):
+        replies = []
+        for call in calls:
+            try:
+                ret = self._call(target_name, target, call)
+                if asyncio.iscoroutine(ret):
+                    ret = yield from ret
+            except Exception:
+                replies.append({"status": "failed",
+                                "message": traceback.format_exc()})
+            else:
+                replies.append({"status": "ok", "ret": ret})
+        return {"status": "ok", "ret": replies}
+
+    @asyncio.coroutine
+    def _await_call(self, coro):
+        try:
+            ret = yield from coro
+        except Exception:
+            return {"status": "failed", "message": traceback.format_exc()}
+        else:
+            return {"status": "ok", "ret": ret}
+
+    @asyncio.coroutine
+    def _finish_call(self, writer, binary, call_id, coro):
+        reply = yield from self._await_call(coro)
+        reply["id"] = call_id
+        _write_obj(writer, reply, binary)
+
 
-def simple_server_loop(targets, host, port, id_parameters=None):
+def simple_server_loop(targets, host, port, id_parameters=None,
+                       executor=None):
     """Runs a server until an exception is raised (e.g. the user hits Ctrl-C).
 
     See ``Server`` for a description of the parameters.
@@ -305,7 +816,7 @@ def simple_server_loop(targets, host, port, id_parameters=None):
     """
     loop = asyncio.get_event_loop()
     try:
-        server = Server(targets, id_parameters)
+        server = Server(targets, id_parameters, executor)
         loop.run_until_complete(server.start(host, port))
         try:
             loop.run_forever()
@@ -15,10 +15,21 @@ that JSON does not support Numpy and more generally cannot be extended with
 other data types while keeping a concise syntax. Here we can use the Python
 function call syntax to mark special data types.
 
+Decoding is done by a dedicated parser instead of ``eval``, which avoids
+compiling a Python code object for each message. The ``Decoder`` class
+supports incremental decoding of data arriving in chunks.
+
+For communication channels, a binary variant of the format is also
+available (``encode_binary`` and ``decode_binary``). It supports the same
+data types, but sends the contents of Numpy arrays as raw little-endian
+buffers instead of base64 strings.
+
 """
 
 
 import base64
+import re
+import struct
 from fractions import Fraction
 
 import numpy
@@ -40,10 +51,31 @@ _encode_map = {
     numpy.ndarray: "nparray"
 }
 
+_str_translation = {ord("\""): "\\\"", ord("\\"): "\\\\", ord("\n"): "\\n"}
+
+# Number of chunks accumulated by the encoder before they are passed to the
+# output function, when one is used.
+_chunks_per_write = 4096
+
+
 class _Encoder:
-    def __init__(self, pretty):
+    """Text PYON encoder.
+
+    The output is accumulated as a list of string chunks that are joined
+    (or written) at the end. Scalars are encoded by methods returning a
+    string, while containers are encoded by generators that append their
+    delimiters to the output and yield their elements. The elements are
+    then processed by ``encode`` using an explicit stack, so that nesting
+    depth is not limited by the Python recursion limit.
+
+    """
+    def __init__(self, pretty, write=None):
         self.pretty = pretty
+        self.write = write
         self.indent_level = 0
+        self.out = []
+        self.dispatch = {t: getattr(self, "encode_" + name)
+                         for t, name in _encode_map.items()}
 
     def indent(self):
         return "    "*self.indent_level
@@ -61,51 +93,76 @@ class _Encoder:
         return str(x)
 
     def encode_str(self, x):
-        tt = {ord("\""): "\\\"", ord("\\"): "\\\\", ord("\n"): "\\n"}
-        return "\"" + x.translate(tt) + "\""
+        return "\"" + x.translate(_str_translation) + "\""
 
     def encode_tuple(self, x):
+        out = self.out
+        out.append("(")
+        first = True
+        for item in x:
+            if not first:
+                out.append(", ")
+            first = False
+            yield item
         if len(x) == 1:
-            return "(" + self.encode(x[0]) + ", )"
-        else:
-            r = "("
-            r += ", ".join([self.encode(item) for item in x])
-            r += ")"
-            return r
+            out.append(", ")
+        out.append(")")
 
     def encode_list(self, x):
-        r = "["
-        r += ", ".join([self.encode(item) for item in x])
-        r += "]"
-        return r
+        out = self.out
+        out.append("[")
+        first = True
+        for item in x:
+            if not first:
+                out.append(", ")
+            first = False
+            yield item
+        out.append("]")
 
     def encode_dict(self, x):
-        r = "{"
+        out = self.out
+        out.append("{")
         if not self.pretty or len(x) < 2:
-            r += ", ".join([self.encode(k) + ": " + self.encode(v)
-                           for k, v in x.items()])
+            first = True
+            for k, v in x.items():
+                if not first:
+                    out.append(", ")
+                first = False
+                yield k
+                out.append(": ")
+                yield v
         else:
             self.indent_level += 1
-            r += "\n"
+            out.append("\n")
             first = True
             for k, v in x.items():
                 if not first:
-                    r += ",\n"
+                    out.append(",\n")
                 first = False
-                r += self.indent() + self.encode(k) + ": " + self.encode(v)
-            r += "\n"  # no ','
+                out.append(self.indent())
+                yield k
+                out.append(": ")
+                yield v
+            out.append("\n")  # no ','
             self.indent_level -= 1
-            r += self.indent()
-        r += "}"
-        return r
+            out.append(self.indent())
+        out.append("}")
 
     def encode_fraction(self, x):
-        return "Fraction({}, {})".format(encode(x.numerator),
-                                         encode(x.denominator))
+        out = self.out
+        out.append("Fraction(")
+        yield x.numerator
+        out.append(", ")
+        yield x.denominator
+        out.append(")")
 
     def encode_quantity(self, x):
-        return "Quantity({}, {})".format(encode(x.amount),
-                                         encode(x.unit))
+        out = self.out
+        out.append("Quantity(")
+        yield x.amount
+        out.append(", ")
+        yield x.unit
+        out.append(")")
 
     def encode_nparray(self, x):
         r = "nparray("
@@ -116,7 +173,32 @@ class _Encoder:
         return r
 
     def encode(self, x):
-        return getattr(self, "encode_" + _encode_map[type(x)])(x)
+        """Encodes ``x`` into the output. Returns the output as a string,
+        or ``None`` if an output function was given.
+
+        """
+        out = self.out
+        write = self.write
+        dispatch = self.dispatch
+        stack = [iter((x, ))]
+        while stack:
+            for item in stack[-1]:
+                r = dispatch[type(item)](item)
+                if isinstance(r, str):
+                    out.append(r)
+                else:
+                    stack.append(r)
+                    break
+            else:
+                stack.pop()
+            if write is not None and len(out) > _chunks_per_write:
+                write("".join(out))
+                out.clear()
+        if write is None:
+            return "".join(out)
+        else:
+            write("".join(out))
+            out.clear()
 
 
 def encode(x, pretty=False):
@@ -127,38 +209,534 @@ def encode(x, pretty=False):
     return _Encoder(pretty).encode(x)
 
 
+def dump(x, f, pretty=False):
+    """Serializes a Python object and writes the result into the file-like
+    object ``f``, in chunks. Unlike ``encode``, the complete string is never
+    built in memory.
+
+    """
+    _Encoder(pretty, f.write).encode(x)
+
+
 def _nparray(shape, dtype, data):
     a = numpy.frombuffer(base64.b64decode(data), dtype=dtype)
     return a.reshape(shape)
 
 
-_eval_dict = {
-    "__builtins__": None,
-
+_constants = {
     "null": None,
     "false": False,
     "true": True,
 
+    "None": None,
+    "False": False,
+    "True": True
+}
+
+_constructors = {
     "Fraction": Fraction,
     "Quantity": Quantity,
     "nparray": _nparray
 }
 
+# Leading whitespace is consumed together with each token, and trailing
+# whitespace is matched alone without a named group.
+# Strings may not contain raw newlines (the encoder escapes them), which
+# guarantees that no token spans a line boundary.
+_token_re = re.compile(r"""
+    \s*(?:
+        (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      | (?P<str>"[^"\\\n]*(?:\\.[^"\\\n]*)*"|'[^'\\\n]*(?:\\.[^'\\\n]*)*')
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<punct>[\[\]{}(),:])
+    )
+  | \s+
+""", re.VERBOSE)
+
+_escape_re = re.compile(r"\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)")
+
+_escapes = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "b": "\b",
+    "f": "\f",
+    "\\": "\\",
+    "\"": "\"",
+    "'": "'",
+    "/": "/"
+}
+
+
+def _unescape_one(m):
+    e = m.group(1)
+    if len(e) > 1:
+        return chr(int(e[1:], 16))
+    try:
+        return _escapes[e]
+    except KeyError:
+        return m.group(0)
+
+
+def _unescape(s):
+    s = s[1:-1]
+    if "\\" in s:
+        s = _escape_re.sub(_unescape_one, s)
+    return s
+
+
+# Parser states for containers on the stack
+_S_VALUE = 0      # expecting a value (or the closing character)
+_S_SEP = 1        # expecting a separator (or the closing character)
+_S_COLON = 2      # dict: expecting the ':' after a key
+_S_DICTVAL = 3    # dict: expecting the value after ':'
+_S_CALL = 4       # constructor name seen, expecting '('
+
+
+class _Parser:
+    """Resumable PYON parser.
+
+    The parser keeps track of unfinished containers on an explicit stack
+    instead of recursing, so that parsing can be suspended at the end of a
+    chunk of input and resumed when more data arrives. This also makes
+    the nesting depth independent of the Python recursion limit.
+
+    Each stack entry is a list ``[opener, items, state, extra]``, where
+    ``extra`` holds the pending key for dicts, the constructor for calls,
+    and whether a comma was seen for parentheses.
+
+    """
+    def __init__(self):
+        self.stack = []
+
+    def reset(self):
+        self.stack = []
+
+    def parse(self, s, pos=0, end=None):
+        """Parses ``s[pos:end]`` and returns the list of top-level objects
+        that were completed. Tokens must not be split across calls.
+
+        """
+        if end is None:
+            end = len(s)
+        try:
+            return self._parse(s, pos, end)
+        except ValueError:
+            self.reset()
+            raise
+
+    def _parse(self, s, pos, end):
+        stack = self.stack
+        results = []
+        scanner = _token_re.scanner(s, pos, end)
+        match = scanner.match
+        while True:
+            m = match()
+            if m is None:
+                break
+            pos = m.end()
+            kind = m.lastgroup
+            if kind is None:
+                continue
+            token = m.group(kind)
+
+            if kind == "number":
+                if "." in token or "e" in token or "E" in token:
+                    value = float(token)
+                else:
+                    value = int(token)
+            elif kind == "str":
+                value = _unescape(token)
+            elif kind == "name":
+                try:
+                    value = _constants[token]
+                except KeyError:
+                    try:
+                        ctor = _constructors[token]
+                    except KeyError:
+                        raise ValueError("Unknown name: " + token)
+                    self._check_value_allowed()
+                    stack.append([token, [], _S_CALL, ctor])
+                    continue
+            else:
+                if token == "[" or token == "{":
+                    self._check_value_allowed()
+                    stack.append([token, [] if token == "[" else dict(),
+                                  _S_VALUE, None])
+                    continue
+                elif token == "(":
+                    if stack and stack[-1][2] == _S_CALL:
+                        stack[-1][2] = _S_VALUE
+                    else:
+                        self._check_value_allowed()
+                        stack.append([token, [], _S_VALUE, False])
+                    continue
+                elif token == ",":
+                    if not stack or stack[-1][2] != _S_SEP:
+                        raise ValueError("Unexpected ','")
+                    top = stack[-1]
+                    top[2] = _S_VALUE
+                    if top[0] == "(":
+                        top[3] = True
+                    continue
+                elif token == ":":
+                    if not stack or stack[-1][2] != _S_COLON:
+                        raise ValueError("Unexpected ':'")
+                    stack[-1][2] = _S_DICTVAL
+                    continue
+                else:
+                    if not stack or stack[-1][2] > _S_SEP:
+                        raise ValueError("Unexpected '" + token + "'")
+                    opener, items, state, extra = stack.pop()
+                    if token == "]" and opener == "[":
+                        value = items
+                    elif token == "}" and opener == "{":
+                        value = items
+                    elif token == ")" and opener == "(":
+                        if len(items) == 1 and not extra:
+                            value = items[0]
+                        else:
+                            value = tuple(items)
+                    elif token == ")" and opener in _constructors:
+                        value = extra(*items)
+                    else:
+                        raise ValueError("Mismatched '" + token + "'")
+
+            if stack:
+                top = stack[-1]
+                state = top[2]
+                if top[0] == "{":
+                    if state == _S_VALUE:
+                        top[3] = value
+                        top[2] = _S_COLON
+                    elif state == _S_DICTVAL:
+                        top[1][top[3]] = value
+                        top[3] = None
+                        top[2] = _S_SEP
+                    else:
+                        raise ValueError("Expected ',' or '}'")
+                else:
+                    if state != _S_VALUE:
+                        raise ValueError("Expected ',' or closing character")
+                    top[1].append(value)
+                    top[2] = _S_SEP
+            else:
+                results.append(value)
+        if pos != end:
+            raise ValueError("Invalid character at position {}".format(pos))
+        return results
+
+    def _check_value_allowed(self):
+        if self.stack:
+            state = self.stack[-1][2]
+            if state != _S_VALUE and state != _S_DICTVAL:
+                raise ValueError("Unexpected value")
+
+
+class Decoder:
+    """Incremental PYON decoder.
+
+    Data can be fed in arbitrary chunks, e.g. as it is received from a
+    socket. Parsing proceeds up to the last complete line of the input, so
+    that a single large object is never parsed more than once regardless of
+    how it was split.
+
+    """
+    def __init__(self):
+        self._parser = _Parser()
+        self._buffer = ""
+
+    def feed(self, data):
+        """Appends a string to the input and returns the list of the objects
+        that have been completed by it (possibly empty).
+
+        Raises ``ValueError`` if the input is not valid PYON. The partially
+        decoded object is then discarded and the decoder is ready to parse
+        new objects starting from the next line.
+
+        """
+        buf = self._buffer + data
+        i = buf.rfind("\n")
+        if i < 0:
+            self._buffer = buf
+            return []
+        self._buffer = buf[i+1:]
+        return self._parser.parse(buf, 0, i+1)
+
+    def pending(self):
+        """Returns ``True`` if an object has been partially received."""
+        return bool(self._parser.stack) or bool(self._buffer.strip())
+
+
 def decode(s):
     """Parses a string in the Python syntax, reconstructs the corresponding
     object, and returns it.
 
+    Raises ``ValueError`` if the string does not contain exactly one valid
+    object.
+
+    """
+    parser = _Parser()
+    r = parser.parse(s)
+    if parser.stack or len(r) != 1:
+        raise ValueError("Incomplete or multiple objects in PYON data")
+    return r[0]
+
+
+# Binary PYON frames are made of:
+#  * the payload length (8 bytes, little endian, see _binary_header)
+#  * the body length (4 bytes, little endian)
+#  * the body, made of type-tagged values
+#  * the contents of all Numpy arrays, concatenated in the order in which
+#    the arrays appear in the body.
+_binary_header = struct.Struct("<Q")
+_u32 = struct.Struct("<I")
+_u64 = struct.Struct("<Q")
+_i64 = struct.Struct("<q")
+_f64 = struct.Struct("<d")
+
+binary_header_size = _binary_header.size
+
+
+class _BinaryEncoder:
+    def __init__(self):
+        self.body = bytearray()
+        self.arrays = []
+        self.dispatch = {t: getattr(self, "encode_" + name)
+                         for t, name in _encode_map.items()}
+
+    def encode_none(self, x):
+        self.body += b"n"
+
+    def encode_bool(self, x):
+        self.body += b"t" if x else b"f"
+
+    def encode_number(self, x):
+        if isinstance(x, float):
+            self.body += b"d"
+            self.body += _f64.pack(x)
+        elif -2**63 <= x < 2**63:
+            self.body += b"i"
+            self.body += _i64.pack(x)
+        else:
+            data = x.to_bytes(x.bit_length()//8 + 1, "little", signed=True)
+            self.body += b"I"
+            self.body += _u32.pack(len(data))
+            self.body += data
+
+    def encode_str(self, x):
+        data = x.encode()
+        self.body += b"s"
+        self.body += _u32.pack(len(data))
+        self.body += data
+
+    def encode_tuple(self, x):
+        self.body += b"("
+        self.body += _u32.pack(len(x))
+        for item in x:
+            self.encode(item)
+
+    def encode_list(self, x):
+        self.body += b"["
+        self.body += _u32.pack(len(x))
+        for item in x:
+            self.encode(item)
+
+    def encode_dict(self, x):
+        self.body += b"{"
+        self.body += _u32.pack(len(x))
+        for k, v in x.items():
+            self.encode(k)
+            self.encode(v)
+
+    def encode_fraction(self, x):
+        self.body += b"F"
+        self.encode(x.numerator)
+        self.encode(x.denominator)
+
+    def encode_quantity(self, x):
+        self.body += b"Q"
+        self.encode(x.amount)
+        self.encode(x.unit)
+
+    def encode_nparray(self, x):
+        if x.dtype.hasobject:
+            raise TypeError("Cannot serialize Numpy arrays of objects")
+        # no copy if the array is already contiguous and little endian
+        x = numpy.require(x, x.dtype.newbyteorder("<"), "C")
+        dtype = x.dtype.str.encode()
+        self.body += b"a"
+        self.body += _u32.pack(x.ndim)
+        for n in x.shape:
+            self.body += _u64.pack(n)
+        self.body += _u32.pack(len(dtype))
+        self.body += dtype
+        self.arrays.append(memoryview(x.reshape(-1).view(numpy.uint8)))
+
+    def encode(self, x):
+        self.dispatch[type(x)](x)
+
+
+def encode_binary(x):
+    """Serializes a Python object into a binary PYON frame.
+
+    Returns a list of bytes-like objects that must be transmitted in order.
+    The first one contains the header, which holds the length of the rest of
+    the frame, and the body. The data of Numpy arrays is not copied: each
+    array is represented by a ``memoryview`` of its buffer. Arrays must
+    therefore not be modified until the frame has been transmitted.
+
+    """
+    encoder = _BinaryEncoder()
+    encoder.encode(x)
+    body = encoder.body
+    length = _u32.size + len(body) + sum(len(a) for a in encoder.arrays)
+    head = _binary_header.pack(length) + _u32.pack(len(body)) + body
+    return [head] + encoder.arrays
+
+
+def decode_binary_header(header):
+    """Returns the length of the payload (the rest of the frame) given the
+    first ``binary_header_size`` bytes of a binary PYON frame.
+
+    """
+    return _binary_header.unpack(header)[0]
+
+
+class _BinaryDecoder:
+    def __init__(self, payload):
+        self.payload = payload
+        self.buf = memoryview(payload)
+        self.pos = _u32.size
+        self.body_end = self.pos + _u32.unpack_from(payload, 0)[0]
+        self.data_pos = self.body_end
+        self.dispatch = {
+            ord("n"): self.decode_none,
+            ord("t"): self.decode_true,
+            ord("f"): self.decode_false,
+            ord("i"): self.decode_int,
+            ord("I"): self.decode_bigint,
+            ord("d"): self.decode_float,
+            ord("s"): self.decode_str,
+            ord("("): self.decode_tuple,
+            ord("["): self.decode_list,
+            ord("{"): self.decode_dict,
+            ord("F"): self.decode_fraction,
+            ord("Q"): self.decode_quantity,
+            ord("a"): self.decode_nparray
+        }
+
+    def unpack(self, st):
+        r = st.unpack_from(self.payload, self.pos)[0]
+        self.pos += st.size
+        return r
+
+    def read_bytes(self, n):
+        end = self.pos + n
+        if end > self.body_end:
+            raise ValueError("Truncated binary PYON data")
+        r = self.buf[self.pos:end]
+        self.pos = end
+        return r
+
+    def decode_none(self):
+        return None
+
+    def decode_true(self):
+        return True
+
+    def decode_false(self):
+        return False
+
+    def decode_int(self):
+        return self.unpack(_i64)
+
+    def decode_bigint(self):
+        n = self.unpack(_u32)
+        return int.from_bytes(self.read_bytes(n), "little", signed=True)
+
+    def decode_float(self):
+        return self.unpack(_f64)
+
+    def decode_str(self):
+        n = self.unpack(_u32)
+        return str(self.read_bytes(n), "utf-8")
+
+    def decode_tuple(self):
+        n = self.unpack(_u32)
+        return tuple(self.decode() for i in range(n))
+
+    def decode_list(self):
+        n = self.unpack(_u32)
+        return [self.decode() for i in range(n)]
+
+    def decode_dict(self):
+        n = self.unpack(_u32)
+        r = dict()
+        for i in range(n):
+            k = self.decode()
+            r[k] = self.decode()
+        return r
+
+    def decode_fraction(self):
+        numerator = self.decode()
+        return Fraction(numerator, self.decode())
+
+    def decode_quantity(self):
+        amount = self.decode()
+        return Quantity(amount, self.decode())
+
+    def decode_nparray(self):
+        ndim = self.unpack(_u32)
+        shape = tuple(self.unpack(_u64) for i in range(ndim))
+        n = self.unpack(_u32)
+        dtype = numpy.dtype(str(self.read_bytes(n), "ascii"))
+        count = 1
+        for d in shape:
+            count *= d
+        offset = self.data_pos
+        self.data_pos += count*dtype.itemsize
+        if self.data_pos > len(self.buf):
+            raise ValueError("Truncated binary PYON data")
+        a = numpy.frombuffer(self.payload, dtype, count, offset)
+        return a.reshape(shape)
+
+    def decode(self):
+        if self.pos >= self.body_end:
+            raise ValueError("Truncated binary PYON data")
+        tag = self.buf[self.pos]
+        self.pos += 1
+        try:
+            method = self.dispatch[tag]
+        except KeyError:
+            raise ValueError("Invalid tag in binary PYON data")
+        return method()
+
+
+def decode_binary(payload):
+    """Reconstructs a Python object from the payload of a binary PYON frame,
+    i.e. the frame without its first ``binary_header_size`` bytes.
+
+    Numpy arrays are created without copying their data, and share memory
+    with ``payload``.
+
     """
-    return eval(s, _eval_dict, {})
+    try:
+        decoder = _BinaryDecoder(payload)
+        r = decoder.decode()
+    except struct.error:
+        raise ValueError("Truncated binary PYON data")
+    if decoder.pos != decoder.body_end or decoder.data_pos != len(payload):
+        raise ValueError("Invalid length in binary PYON data")
+    return r
 
 
 def store_file(filename, x):
     """Encodes a Python object and writes it to the specified file.
 
     """
-    contents = encode(x, True)
     with open(filename, "w") as f:
-        f.write(contents)
+        dump(x, f, True)
         f.write("\n")
 
 
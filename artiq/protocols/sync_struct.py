@@ -7,29 +7,104 @@ subscriber upon connection (*initialization*), followed by dictionaries
 describing each modification made to the structure (*mods*).
 
 Structures must be PYON serializable and contain only lists, dicts, and
-immutable types. Lists and dicts can be nested arbitrarily.
+immutable types. Lists and dicts can be nested arbitrarily. NumPy arrays
+may be used as leaves, and rows can be appended to them efficiently with
+``Notifier.append_block``.
+
+Subscribers may request that the publisher uses binary PYON, which is more
+efficient for structures containing large Numpy arrays.
+
+The publisher can coalesce the mods made within a short time window: appends
+to the same list are merged into one ``extend`` mod, a ``setitem`` replaces
+an earlier one on the same key, and the remaining mods are sent together as
+one ``batch`` mod.
+
+The publisher numbers the frames it sends, and can keep the most recent ones
+so that a subscriber that reconnects only receives the frames it missed,
+instead of a new initialization.
 
 """
 
 import asyncio
 from operator import getitem
+from copy import deepcopy
+from collections import deque
+from uuid import uuid4
+import weakref
+
+import numpy
 
 from artiq.protocols import pyon
 from artiq.protocols.asyncio_server import AsyncioServer
 
 
 _init_string = b"ARTIQ sync_struct\n"
+_binary_encoding = "pyon_binary"
+
+
+# id of storage array -> [weak reference to the storage, number of rows used]
+_array_storages = dict()
+
+
+def _append_block(container, key, x):
+    # Replaces container[key] with a NumPy array that has the rows of x
+    # appended. The returned array is a view of the beginning of a larger
+    # storage array, whose unused rows are filled by the next appends
+    # as long as container[key] remains the last view created from it.
+    a = container[key]
+    if not isinstance(a, numpy.ndarray):
+        a = numpy.array(a, x.dtype).reshape((-1, ) + x.shape[1:])
+    n = len(a)
+    m = len(x)
+    storage = a.base
+    try:
+        storage_ref, used = _array_storages[id(storage)]
+    except KeyError:
+        valid = False
+    else:
+        valid = (storage_ref() is storage and used == n
+                 and a.__array_interface__["data"][0]
+                     == storage.__array_interface__["data"][0]
+                 and len(storage) >= n + m)
+    if not valid:
+        storage = numpy.empty((max(2*(n + m), 16), ) + a.shape[1:], a.dtype)
+        storage[:n] = a
+        key_id = id(storage)
+        _array_storages[key_id] = [
+            weakref.ref(storage,
+                        lambda r: _array_storages.pop(key_id, None)),
+            n]
+    storage[n:n + m] = x
+    _array_storages[id(storage)][1] = n + m
+    r = storage[:n + m]
+    container[key] = r
+    return r
 
 
 def process_mod(target, mod):
     """Apply a *mod* to the target, mutating it.
 
     """
+    action = mod["action"]
+    if action == "batch":
+        for m in mod["mods"]:
+            process_mod(target, m)
+        return
+    if action == "append_block":
+        path = mod["path"]
+        for key in path[:-1]:
+            target = getitem(target, key)
+        if isinstance(target, Notifier):
+            target[path[-1]].append_block(mod["x"])
+        else:
+            _append_block(target, path[-1], mod["x"])
+        return
     for key in mod["path"]:
         target = getitem(target, key)
-    action = mod["action"]
     if action == "append":
         target.append(mod["x"])
+    elif action == "extend":
+        target.extend(mod["x"])
     elif action == "insert":
         target.insert(mod["i"], mod["x"])
     elif action == "pop":
@@ -50,13 +125,27 @@ class Subscriber:
         the object received from the publisher and returns the corresponding
         local structure to use. Can be identity.
     :param notify_cb: An optional function called every time a mod is received
-        from the publisher. The mod is passed as parameter.
+        from the publisher. The mod is passed as parameter. Batches are
+        split, and the callback is called for each mod they contain.
+    :param binary: Request binary PYON from the publisher. The publisher
+        must support it.
+
+    When ``connect`` is called again after a connection was closed or lost,
+    the subscriber asks the publisher to resume from the last frame it
+    received. If the publisher still has the missed frames, the local
+    structure is kept and only those frames are applied. Otherwise, a new
+    initialization takes place as on the first connection.
 
     """
-    def __init__(self, notifier_name, target_builder, notify_cb=None):
+    def __init__(self, notifier_name, target_builder, notify_cb=None,
+                 binary=False):
         self.notifier_name = notifier_name
         self.target_builder = target_builder
         self.notify_cb = notify_cb
+        self.binary = binary
+        self._target = None
+        self._epoch = None
+        self._seq = None
 
     @asyncio.coroutine
     def connect(self, host, port):
@@ -64,7 +153,12 @@ class Subscriber:
             yield from asyncio.open_connection(host, port)
         try:
             self._writer.write(_init_string)
-            self._writer.write((self.notifier_name + "\n").encode())
+            line = self.notifier_name
+            if self.binary:
+                line += " " + _binary_encoding
+            if self._epoch is not None:
+                line += " resume={},{}".format(self._epoch, self._seq)
+            self._writer.write((line + "\n").encode())
             self.receive_task = asyncio.Task(self._receive_cr())
         except:
             self._writer.close()
@@ -87,20 +181,38 @@ class Subscriber:
 
     @asyncio.coroutine
     def _receive_cr(self):
-        target = None
         while True:
-            line = yield from self._reader.readline()
-            if not line:
-                return
-            mod = pyon.decode(line.decode())
+            if self.binary:
+                try:
+                    header = yield from self._reader.readexactly(
+                        pyon.binary_header_size)
+                    payload = yield from self._reader.readexactly(
+                        pyon.decode_binary_header(header))
+                except asyncio.IncompleteReadError:
+                    return
+                mod = pyon.decode_binary(payload)
+            else:
+                line = yield from self._reader.readline()
+                if not line:
+                    return
+                mod = pyon.decode(line.decode())
 
             if mod["action"] == "init":
-                target = self.target_builder(mod["struct"])
+                self._target = self.target_builder(mod["struct"])
+                self._epoch = mod["epoch"]
+                mods = [mod]
+            elif mod["action"] == "batch":
+                mods = mod["mods"]
+                for m in mods:
+                    process_mod(self._target, m)
             else:
-                process_mod(target, mod)
+                process_mod(self._target, mod)
+                mods = [mod]
+            self._seq = mod["seq"]
 
             if self.notify_cb is not None:
-                self.notify_cb(mod)
+                for m in mods:
+                    self.notify_cb(m)
 
 
 class Notifier:
@@ -126,7 +238,15 @@ class Notifier:
     :param backing_struct: Structure to encapsulate. For convenience, it
         also becomes available as the ``read`` property of the ``Notifier``.
 
+    The ``Notifier`` objects returned by the index syntax are kept and
+    reused for the following accesses with the same index, until the
+    structure they designate is modified, so that e.g. appending to a
+    nested list in a loop does not allocate a ``Notifier`` each time.
+
     """
+    __slots__ = ("read", "root", "publish",
+                 "_backing_struct", "_path", "_children", "_parent")
+
     def __init__(self, backing_struct, root=None, path=[]):
         self.read = backing_struct
         if root is None:
@@ -136,6 +256,17 @@ class Notifier:
             self.root = root
         self._backing_struct = backing_struct
         self._path = path
+        self._children = dict()
+        self._parent = None
+
+    def _forget_children(self, key):
+        # Drops the cached child views that may no longer designate the
+        # same element. In lists, all indices may have shifted.
+        if self._children:
+            if isinstance(self._backing_struct, dict):
+                self._children.pop(key, None)
+            else:
+                self._children.clear()
 
     # Backing struct modification methods.
     # All modifications must go through them!
@@ -145,16 +276,56 @@ class Notifier:
 
         """
         self._backing_struct.append(x)
+        self._forget_children(None)
         if self.root.publish is not None:
             self.root.publish(self.root, {"action": "append",
                                           "path": self._path,
                                           "x": x})
 
+    def extend(self, l):
+        """Append all elements of an iterable to a list. This generates a
+        single mod.
+
+        """
+        l = list(l)
+        self._backing_struct.extend(l)
+        self._forget_children(None)
+        if self.root.publish is not None:
+            self.root.publish(self.root, {"action": "extend",
+                                          "path": self._path,
+                                          "x": l})
+
+    def append_block(self, x):
+        """Append the rows of the NumPy array *x* to the array designated by
+        this ``Notifier``, which must have been obtained with the index
+        syntax. A list is converted to an array.
+
+        The array is replaced by a view of a larger storage array, which
+        grows geometrically, so that appending a row is done in amortized
+        constant time. Subscribers receive the rows in a single mod.
+
+        """
+        if self._parent is None:
+            raise TypeError("Only elements of a structure can be appended "
+                            "blocks to")
+        x = numpy.asarray(x)
+        parent = self._parent
+        key = self._path[-1]
+        self.read = self._backing_struct = _append_block(
+            parent._backing_struct, key, x)
+        parent._forget_children(key)
+        parent._children[key] = self
+        if self.root.publish is not None:
+            self.root.publish(self.root, {"action": "append_block",
+                                          "path": self._path,
+                                          "x": x})
+
     def insert(self, i, x):
         """Insert an element into a list.
 
         """
         self._backing_struct.insert(i, x)
+        self._forget_children(None)
         if self.root.publish is not None:
             self.root.publish(self.root, {"action": "insert",
                                           "path": self._path,
@@ -167,6 +338,7 @@ class Notifier:
 
         """
         r = self._backing_struct.pop(i)
+        self._forget_children(None)
         if self.root.publish is not None:
             self.root.publish(self.root, {"action": "pop",
                                           "path": self._path,
@@ -175,6 +347,7 @@ class Notifier:
 
     def __setitem__(self, key, value):
         self._backing_struct.__setitem__(key, value)
+        self._forget_children(key)
         if self.root.publish is not None:
             self.root.publish(self.root, {"action": "setitem",
                                 "path": self._path,
@@ -183,14 +356,125 @@ class Notifier:
 
     def __delitem__(self, key):
         self._backing_struct.__delitem__(key)
+        self._forget_children(key)
         if self.root.publish is not None:
             self.root.publish(self.root, {"action": "delitem",
                                           "path": self._path,
                                           "key": key})
 
     def __getitem__(self, key):
+        try:
+            return self._children[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable key, e.g. a slice
+            item = getitem(self._backing_struct, key)
+            child = Notifier(item, self.root, self._path + [key])
+            child._parent = self
+            return child
         item = getitem(self._backing_struct, key)
-        return Notifier(item, self.root, self._path + [key])
+        child = Notifier(item, self.root, self._path + [key])
+        child._parent = self
+        self._children[key] = child
+        return child
+
+
+# Number of pending mods that are searched for one that a new mod
+# can be merged into.
+_coalesce_lookback = 16
+
+
+def _keys_may_alias(a, b):
+    # Negative and non-negative list indices can designate the same element.
+    return (a == b
+            or (type(a) is int and type(b) is int and (a < 0) != (b < 0)))
+
+
+def _independent(mod, location):
+    # True if applying the mod can neither change nor depend on what is
+    # stored at location, i.e. if their paths definitely diverge.
+    touched = mod["path"]
+    if mod["action"] == "setitem":
+        touched = touched + [mod["key"]]
+    for a, b in zip(touched, location):
+        if not _keys_may_alias(a, b):
+            return True
+    return False
+
+
+def coalesce_mod(pending, mod):
+    """Add a *mod* to the list of *pending* mods, merging it into a previous
+    one when it can be moved next to it without changing the result of
+    applying them in order.
+
+    ``append`` and ``extend`` mods are merged into a previous ``append`` or
+    ``extend`` mod on the same path, which becomes an ``extend``.
+    ``append_block`` mods are merged into a previous ``append_block`` mod
+    on the same path, whose array gets the new rows. ``setitem`` mods
+    replace a previous ``setitem`` mod with the same path and key. Other
+    mods, including ``insert``, are never merged and are added at the end.
+
+    Only the last few pending mods are searched, and the search stops at
+    the first one that may affect or depend on the location of *mod*. The
+    pending mods and *mod* may be modified or kept, so they must not be
+    shared with the structure.
+
+    """
+    action = mod["action"]
+    if action in ("append", "extend"):
+        location = mod["path"]
+        mergeable = ("append", "extend")
+    elif action == "append_block":
+        location = mod["path"]
+        mergeable = ("append_block", )
+    elif action == "setitem":
+        location = mod["path"] + [mod["key"]]
+        mergeable = ("setitem", )
+    else:
+        pending.append(mod)
+        return
+    for i in range(len(pending) - 1,
+                   max(len(pending) - _coalesce_lookback, 0) - 1, -1):
+        candidate = pending[i]
+        if (candidate["action"] in mergeable
+                and candidate["path"] == mod["path"]
+                and (action != "setitem" or candidate["key"] == mod["key"])):
+            if action == "setitem":
+                pending[i] = mod
+                return
+            if action == "append_block":
+                _append_block(candidate, "x", mod["x"])
+                return
+            if candidate["action"] == "append":
+                candidate = {"action": "extend",
+                             "path": mod["path"],
+                             "x": [candidate["x"]]}
+                pending[i] = candidate
+            if action == "append":
+                candidate["x"].append(mod["x"])
+            else:
+                candidate["x"].extend(mod["x"])
+            return
+        if not _independent(candidate, location):
+            break
+    pending.append(mod)
+
+
+def _encode_frame(obj, binary):
+    if binary:
+        # copy Numpy array data now, as it may be modified before
+        # the frame is sent
+        return b"".join(pyon.encode_binary(obj))
+    else:
+        return (pyon.encode(obj) + "\n").encode()
+
+
+def _decode_frame(frame, binary):
+    if binary:
+        return pyon.decode_binary(frame[pyon.binary_header_size:])
+    else:
+        return pyon.decode(frame.decode())
 
 
 class Publisher(AsyncioServer):
@@ -200,17 +484,62 @@ class Publisher(AsyncioServer):
     :param notifiers: A dictionary containing the notifiers to associate with
         the ``Publisher``. The keys of the dictionary are the names of the
         notifiers to be used with ``Subscriber``.
+    :param coalesce_window: If not ``None``, mods are not sent immediately
+        but held for this time (in seconds) after the first of them, merged
+        when possible, and sent as a single batch.
+    :param queue_limit: If not ``None``, the maximum number of frames that
+        may wait to be sent to a subscriber. Subscribers that do not keep up
+        are handled according to ``overflow_policy``.
+    :param overflow_policy: ``"resync"`` discards the frames waiting for the
+        subscriber and sends it a new initialization instead. ``"disconnect"``
+        closes the connection to the subscriber.
+    :param resume_buffer: If not ``None``, the maximum total size in bytes
+        of the most recent frames kept for each notifier to resume the
+        subscriptions of subscribers that reconnect. Subscribers that missed
+        older frames are sent a new initialization instead.
 
     """
-    def __init__(self, notifiers):
+    def __init__(self, notifiers, coalesce_window=None,
+                 queue_limit=None, overflow_policy="resync",
+                 resume_buffer=None):
+        if overflow_policy not in ("resync", "disconnect"):
+            raise ValueError("Unknown overflow policy: " + overflow_policy)
         AsyncioServer.__init__(self)
         self.notifiers = notifiers
+        self.coalesce_window = coalesce_window
+        self.queue_limit = queue_limit
+        self.overflow_policy = overflow_policy
+        self._overflows = {k: 0 for k in notifiers.keys()}
+        # (notifier name, binary) -> encoded init frame
+        self._init_cache = dict()
+        # Frames are numbered from 1 for each notifier. The epoch
+        # distinguishes the numbering of this publisher from that of other
+        # (e.g. restarted) ones.
+        self._epoch = uuid4().hex
+        self._seq = {k: 0 for k in notifiers.keys()}
+        self.resume_buffer = resume_buffer
+        # notifier name -> deque of [seq, text frame, binary frame]
+        if resume_buffer is None:
+            self._history = dict()
+        else:
+            self._history = {k: deque() for k in notifiers.keys()}
+        # notifier name -> total size of the frames in the history
+        self._history_size = {k: 0 for k in notifiers.keys()}
         self._recipients = {k: set() for k in notifiers.keys()}
+        self._binary_recipients = {k: set() for k in notifiers.keys()}
         self._notifier_names = {id(v): k for k, v in notifiers.items()}
+        self._pending = {k: [] for k in notifiers.keys()}
+        self._flush_handles = dict()
 
         for notifier in notifiers.values():
             notifier.publish = self.publish
 
+    @asyncio.coroutine
+    def stop(self):
+        for notifier_name in list(self._flush_handles.keys()):
+            self._flush(notifier_name)
+        yield from AsyncioServer.stop(self)
+
     @asyncio.coroutine
     def _handle_connection_cr(self, reader, writer):
         try:
@@ -221,36 +550,184 @@ class Publisher(AsyncioServer):
             line = yield from reader.readline()
             if not line:
                 return
-            notifier_name = line.decode()[:-1]
-
-            try:
-                notifier = self.notifiers[notifier_name]
-            except KeyError:
+            notifier_name, *options = line.decode()[:-1].split(" ")
+            binary = False
+            resume = None
+            for option in options:
+                if option == _binary_encoding:
+                    binary = True
+                elif option.startswith("resume="):
+                    epoch, seq = option[7:].split(",")
+                    resume = epoch, int(seq)
+                else:
+                    return
+            if binary:
+                recipients = self._binary_recipients
+            else:
+                recipients = self._recipients
+            if notifier_name not in self.notifiers:
                 return
 
-            obj = {"action": "init", "struct": notifier.read}
-            line = pyon.encode(obj) + "\n"
-            writer.write(line.encode())
+            # pending mods are already reflected in the structure
+            self._flush(notifier_name)
+            frames = None
+            if resume is not None and resume[0] == self._epoch:
+                frames = self._get_missed_frames(notifier_name, resume[1],
+                                                 binary)
+            if frames is None:
+                writer.write(self._encode_init(notifier_name, binary))
+            else:
+                writer.writelines(frames)
 
-            queue = asyncio.Queue()
-            self._recipients[notifier_name].add(queue)
+            queue = asyncio.Queue(self.queue_limit or 0)
+            recipients[notifier_name].add(queue)
             try:
                 while True:
                     line = yield from queue.get()
+                    if line is None:
+                        # disconnected by overflow policy
+                        break
                     writer.write(line)
                     # raise exception on connection error
                     yield from writer.drain()
             finally:
-                self._recipients[notifier_name].remove(queue)
+                recipients[notifier_name].remove(queue)
         except ConnectionResetError:
             # subscribers disconnecting are a normal occurence
             pass
+        except ValueError:
+            # malformed resume option
+            pass
         finally:
             writer.close()
 
     def publish(self, notifier, obj):
-        line = pyon.encode(obj) + "\n"
-        line = line.encode()
         notifier_name = self._notifier_names[id(notifier)]
-        for recipient in self._recipients[notifier_name]:
-            recipient.put_nowait(line)
+        self._init_cache.pop((notifier_name, False), None)
+        self._init_cache.pop((notifier_name, True), None)
+        if self.coalesce_window is None:
+            self._send(notifier_name, obj)
+            return
+        if not (self._recipients[notifier_name]
+                or self._binary_recipients[notifier_name]
+                or notifier_name in self._history):
+            return
+        # the structure may be modified in place before the mod is sent
+        coalesce_mod(self._pending[notifier_name], deepcopy(obj))
+        if notifier_name not in self._flush_handles:
+            self._flush_handles[notifier_name] = \
+                asyncio.get_event_loop().call_later(
+                    self.coalesce_window, self._flush, notifier_name)
+
+    def _flush(self, notifier_name):
+        try:
+            handle = self._flush_handles.pop(notifier_name)
+        except KeyError:
+            return
+        handle.cancel()
+        mods = self._pending[notifier_name]
+        self._pending[notifier_name] = []
+        if len(mods) == 1:
+            self._send(notifier_name, mods[0])
+        else:
+            self._send(notifier_name, {"action": "batch", "mods": mods})
+
+    def _encode_init(self, notifier_name, binary):
+        # The encoded structure is kept until the next mod, and shared by
+        # all subscribers connecting or resynchronizing in the meantime.
+        try:
+            return self._init_cache[(notifier_name, binary)]
+        except KeyError:
+            pass
+        obj = {"action": "init", "struct": self.notifiers[notifier_name].read,
+               "epoch": self._epoch, "seq": self._seq[notifier_name]}
+        r = _encode_frame(obj, binary)
+        self._init_cache[(notifier_name, binary)] = r
+        return r
+
+    def _get_missed_frames(self, notifier_name, seq, binary):
+        # Returns the frames numbered after seq, or None if some of them
+        # are no longer available.
+        history = self._history.get(notifier_name)
+        if seq == self._seq[notifier_name]:
+            return []
+        if (not history or seq > self._seq[notifier_name]
+                or history[0][0] > seq + 1):
+            return None
+        r = []
+        for entry in history:
+            if entry[0] > seq:
+                if entry[1 + binary] is None:
+                    obj = _decode_frame(entry[2 - binary], not binary)
+                    entry[1 + binary] = _encode_frame(obj, binary)
+                    self._history_size[notifier_name] += \
+                        len(entry[1 + binary])
+                r.append(entry[1 + binary])
+        self._trim_history(notifier_name)
+        return r
+
+    def _trim_history(self, notifier_name):
+        history = self._history[notifier_name]
+        while self._history_size[notifier_name] > self.resume_buffer:
+            entry = history.popleft()
+            self._history_size[notifier_name] -= sum(
+                len(frame) for frame in entry[1:] if frame is not None)
+
+    def _send(self, notifier_name, obj):
+        self._init_cache.pop((notifier_name, False), None)
+        self._init_cache.pop((notifier_name, True), None)
+        self._seq[notifier_name] += 1
+        seq = self._seq[notifier_name]
+        obj = dict(obj, seq=seq)
+        frames = [None, None]
+        recipients = self._recipients[notifier_name]
+        if recipients:
+            frames[0] = _encode_frame(obj, False)
+            self._enqueue(notifier_name, recipients, frames[0], False)
+        recipients = self._binary_recipients[notifier_name]
+        if recipients:
+            frames[1] = _encode_frame(obj, True)
+            self._enqueue(notifier_name, recipients, frames[1], True)
+        history = self._history.get(notifier_name)
+        if history is not None:
+            if frames == [None, None]:
+                frames[1] = _encode_frame(obj, True)
+            history.append([seq] + frames)
+            self._history_size[notifier_name] += sum(
+                len(frame) for frame in frames if frame is not None)
+            self._trim_history(notifier_name)
+
+    def _enqueue(self, notifier_name, recipients, frame, binary):
+        init = None
+        for recipient in recipients:
+            try:
+                recipient.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._overflows[notifier_name] += 1
+                while not recipient.empty():
+                    recipient.get_nowait()
+                if self.overflow_policy == "resync":
+                    # the structure already reflects the dropped frames
+                    if init is None:
+                        init = self._encode_init(notifier_name, binary)
+                    recipient.put_nowait(init)
+                else:
+                    recipient.put_nowait(None)
+
+    def get_queue_stats(self):
+        """Returns, for each notifier, a dictionary with the number of
+        subscribers (``subscribers``), the numbers of frames waiting to be
+        sent to each of them (``queue_depths``), and the number of times a
+        subscriber queue overflowed (``overflows``).
+
+        """
+        r = dict()
+        for notifier_name in self.notifiers.keys():
+            queues = (self._recipients[notifier_name]
+                      | self._binary_recipients[notifier_name])
+            r[notifier_name] = {
+                "subscribers": len(queues),
+                "queue_depths": sorted(q.qsize() for q in queues),
+                "overflows": self._overflows[notifier_name]
+            }
+        return r
@@ -0,0 +1,126 @@
+import unittest
+import os
+import tempfile
+
+from artiq.protocols import pyon
+from artiq.protocols.file_db import FlatFileDB, PersistentHistory
+
+
+class FlatFileDBCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "db.pyon")
+        pyon.store_file(self.filename, {"a": 1, "b": 2})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_journal(self):
+        db = FlatFileDB(self.filename, journal=True, journal_limit=10)
+        for i in range(15):
+            db.set("a", i)
+        db.delete("b")
+        # 10 changes were compacted
+        self.assertEqual(pyon.load_file(self.filename), {"a": 9, "b": 2})
+        with open(self.filename + ".journal") as f:
+            self.assertEqual(len(f.readlines()), 6)
+        # reload without closing, as after a crash
+        db2 = FlatFileDB(self.filename, journal=True)
+        self.assertEqual(db2.data.read, {"a": 14})
+        self.assertEqual(pyon.load_file(self.filename), {"a": 14})
+        db2.close()
+        db._journal_file.close()
+
+    def test_recovery(self):
+        db = FlatFileDB(self.filename, journal=True, fsync="always")
+        db.set("c", [1, 2])
+        db.delete("b")
+        db._journal_file.close()
+        with open(self.filename + ".journal", "a") as f:
+            # interrupted while writing a change
+            f.write("{\"action\": \"setitem\", \"path\": [], \"ke")
+        # interrupted before the journal was emptied by a compaction
+        pyon.store_file(self.filename, {"a": 1, "c": [1, 2]})
+        db = FlatFileDB(self.filename, journal=True)
+        self.assertEqual(db.data.read, {"a": 1, "c": [1, 2]})
+        db.set("d", 4)
+        db.close()
+        db = FlatFileDB(self.filename, journal=True)
+        self.assertEqual(db.data.read, {"a": 1, "c": [1, 2], "d": 4})
+        db.close()
+
+    def test_background_save(self):
+        db = FlatFileDB(self.filename, save_delay=0.5)
+        for i in range(10):
+            db.set("a", i)
+        db.delete("b")
+        # still waiting for more changes
+        self.assertEqual(pyon.load_file(self.filename), {"a": 1, "b": 2})
+        db.flush()
+        self.assertEqual(pyon.load_file(self.filename), {"a": 9})
+        db.set("c", 3)
+        db.close()
+        self.assertEqual(pyon.load_file(self.filename), {"a": 9, "c": 3})
+        self.assertEqual(os.listdir(self.tmpdir.name), ["db.pyon"])
+        self.assertRaises(ValueError, FlatFileDB, self.filename,
+                          journal=True, save_delay=0.5)
+
+
+class PersistentHistoryCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "history.dat")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_history(self):
+        history = PersistentHistory(self.filename)
+        try:
+            for i in range(10):
+                history.set(100.0 + i, "a", i)
+                history.set(100.5 + i, "b", [i])
+            history.delete(120.0, "a")
+            history.set(121.0, "a", None)
+        finally:
+            history.close()
+        with open(self.filename, "ab") as f:
+            # interrupted while writing a record
+            f.write(b"\x00\x01\x02")
+        history = PersistentHistory(self.filename)
+        try:
+            self.assertEqual(history.get_names(), ["a", "b"])
+            self.assertEqual(history.get("a", 105.2), 5)
+            self.assertEqual(history.get("b", 105.7), [5])
+            self.assertEqual(history.get("b"), [9])
+            self.assertIsNone(history.get("a"))
+            with self.assertRaises(KeyError):
+                history.get("a", 99.0)
+            with self.assertRaises(KeyError):
+                history.get("a", 120.5)
+            self.assertEqual(history.get_changes("a", 107.0, 120.0),
+                             [(107.0, 7), (108.0, 8), (109.0, 9), (120.0, )])
+            self.assertEqual(history.get_changes("b", end=101.0),
+                             [(100.5, [0])])
+            history.set(122.0, "b", 1)
+        finally:
+            history.close()
+        history = PersistentHistory(self.filename)
+        try:
+            self.assertEqual(history.get("b"), 1)
+        finally:
+            history.close()
+
+    def test_hook(self):
+        db_filename = os.path.join(self.tmpdir.name, "db.pyon")
+        db = FlatFileDB(db_filename, default_data=dict())
+        history = PersistentHistory(self.filename)
+        try:
+            db.hooks.append(history)
+            db.set("x", 1)
+            db.set("x", 2)
+            db.delete("x")
+            changes = history.get_changes("x")
+            self.assertEqual([c[1:] for c in changes], [(1, ), (2, ), ()])
+        finally:
+            history.close()
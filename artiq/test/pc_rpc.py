@@ -3,6 +3,7 @@ import sys
 import subprocess
 import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -14,6 +15,8 @@ test_port = 7777
 test_object = [5, 2.1, None, True, False,
                {"a": 5, 2: np.linspace(0, 10, 1)},
                (4, 5), (10,), "ab\nx\"'"]
+# too large for a PYON text line
+test_large_array = np.arange(100000)
 
 
 class RPCCase(unittest.TestCase):
@@ -30,12 +33,12 @@ class RPCCase(unittest.TestCase):
                     proc.kill()
                     raise
 
-    def _blocking_echo(self):
+    def _blocking_echo(self, binary):
         for attempt in range(100):
             time.sleep(.2)
             try:
                 remote = pc_rpc.Client(test_address, test_port,
-                                       "test")
+                                       "test", binary)
             except ConnectionRefusedError:
                 pass
             else:
@@ -43,22 +46,55 @@ class RPCCase(unittest.TestCase):
         try:
             test_object_back = remote.echo(test_object)
             self.assertEqual(test_object, test_object_back)
+            if binary:
+                test_array_back = remote.echo(test_large_array)
+                self.assertTrue(np.array_equal(test_large_array,
+                                               test_array_back))
+            # large replies are supported in text mode too
+            self.assertTrue(np.array_equal(test_large_array,
+                                           remote.arange(100000)))
             with self.assertRaises(pc_rpc.RemoteError):
                 remote.non_existing_method()
+            self.assertEqual(remote.delayed_echo(0.1, "x"), "x")
+            with remote.batch_rpc() as batch:
+                batch.echo(1)
+                batch.non_existing_method()
+                batch.delayed_echo(0.1, 2)
+            r1, r2, r3 = batch.get_rpc_results()
+            self.assertEqual((r1, r3), (1, 2))
+            self.assertIsInstance(r2, pc_rpc.RemoteError)
             remote.quit()
         finally:
             remote.close_rpc()
 
     def test_blocking_echo(self):
-        self._run_server_and_test(self._blocking_echo)
+        self._run_server_and_test(lambda: self._blocking_echo(True))
+
+    def test_blocking_echo_text(self):
+        self._run_server_and_test(lambda: self._blocking_echo(False))
+
+    def _pool_echo(self):
+        pool = pc_rpc.ClientPool(retry_timeout=20)
+        try:
+            remote = pool.get(test_address, test_port, "test")
+            self.assertIs(remote, pool.get(test_address, test_port, "test"))
+            self.assertEqual(remote.echo(test_object), test_object)
+            self.assertTrue(remote.is_rpc_connected())
+            remote.quit()
+        finally:
+            pool.close()
+
+    def test_pool_echo(self):
+        self._run_server_and_test(self._pool_echo)
 
     @asyncio.coroutine
-    def _asyncio_echo(self):
+    def _asyncio_echo(self, binary):
         remote = pc_rpc.AsyncioClient()
         for attempt in range(100):
             yield from asyncio.sleep(.2)
             try:
-                yield from remote.connect_rpc(test_address, test_port, "test")
+                yield from remote.connect_rpc(test_address, test_port, "test",
+                                              binary)
             except ConnectionRefusedError:
                 pass
             else:
@@ -66,21 +102,50 @@ class RPCCase(unittest.TestCase):
         try:
             test_object_back = yield from remote.echo(test_object)
             self.assertEqual(test_object, test_object_back)
+            if binary:
+                test_array_back = yield from remote.echo(test_large_array)
+                self.assertTrue(np.array_equal(test_large_array,
+                                               test_array_back))
             with self.assertRaises(pc_rpc.RemoteError):
                 yield from remote.non_existing_method()
+            # the slow call must not block the fast one
+            slow = asyncio.Task(remote.delayed_echo(1.0, "slow"))
+            fast = asyncio.Task(remote.delayed_echo(0.0, "fast"))
+            done, pending = yield from asyncio.wait(
+                [slow, fast], return_when=asyncio.FIRST_COMPLETED)
+            self.assertEqual(done, {fast})
+            self.assertEqual(fast.result(), "fast")
+            self.assertEqual((yield from slow), "slow")
+            # blocking methods must not block the event loop of the server
+            slow = asyncio.Task(remote.blocking_sleep(1.0))
+            fast = asyncio.Task(remote.delayed_echo(0.0, "fast"))
+            done, pending = yield from asyncio.wait(
+                [slow, fast], return_when=asyncio.FIRST_COMPLETED)
+            self.assertEqual(done, {fast})
+            yield from slow
+            with remote.batch_rpc() as batch:
+                batch.echo(1)
+                batch.non_existing_method()
+            r1, r2 = yield from batch.get_rpc_results()
+            self.assertEqual(r1, 1)
+            self.assertIsInstance(r2, pc_rpc.RemoteError)
             yield from remote.quit()
         finally:
             remote.close_rpc()
 
-    def _loop_asyncio_echo(self):
-        loop = asyncio.get_event_loop()
+    def _loop_asyncio_echo(self, binary):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(self._asyncio_echo())
+            loop.run_until_complete(self._asyncio_echo(binary))
         finally:
             loop.close()
 
     def test_asyncio_echo(self):
-        self._run_server_and_test(self._loop_asyncio_echo)
+        self._run_server_and_test(lambda: self._loop_asyncio_echo(True))
+
+    def test_asyncio_echo_text(self):
+        self._run_server_and_test(lambda: self._loop_asyncio_echo(False))
 
 
 class Echo:
@@ -91,23 +156,38 @@ class Echo:
     def wait_quit(self):
         yield from self.terminate_notify.acquire()
 
+    @asyncio.coroutine
     def quit(self):
+        # runs in the event loop, not in the executor, so that the reply is
+        # written before the server is stopped
         self.terminate_notify.release()
 
+    def blocking_sleep(self, delay):
+        time.sleep(delay)
+
     def echo(self, x):
         return x
 
+    def arange(self, n):
+        return np.arange(n)
+
+    @asyncio.coroutine
+    def delayed_echo(self, delay, x):
+        yield from asyncio.sleep(delay)
+        return x
+
 
 def run_server():
     loop = asyncio.get_event_loop()
     try:
         echo = Echo()
-        server = pc_rpc.Server({"test": echo})
-        loop.run_until_complete(server.start(test_address, test_port))
-        try:
-            loop.run_until_complete(echo.wait_quit())
-        finally:
-            loop.run_until_complete(server.stop())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            server = pc_rpc.Server({"test": echo}, executor=executor)
+            loop.run_until_complete(server.start(test_address, test_port))
+            try:
+                loop.run_until_complete(echo.wait_quit())
+            finally:
+                loop.run_until_complete(server.stop())
     finally:
         loop.close()
 
@@ -0,0 +1,308 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import heapq
+from unittest.mock import patch
+from time import time
+from datetime import datetime
+
+from artiq.master.scheduler import Scheduler, CronSchedule
+
+
+_sleep_unit = """
+import os
+import time
+
+from artiq.language.db import *
+
+
+class Sleep(AutoDB):
+    class DBKeys:
+        implicit_core = False
+        name = Argument()
+        duration = Argument()
+        crash = Argument(False)
+        prepare_duration = Argument(0)
+        log = Parameter()
+
+    @staticmethod
+    def realtime_results():
+        return dict()
+
+    def prepare(self):
+        time.sleep(self.prepare_duration)
+        self.log = ("prepare", self.name)
+
+    def run(self):
+        self.log = ("start", self.name, os.getpid())
+        if self.crash:
+            os._exit(1)
+        time.sleep(self.duration)
+        self.log = ("end", self.name)
+
+    def analyze(self):
+        self.log = ("analyze", self.name)
+"""
+
+
+class SchedulerCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.unit_file = os.path.join(self.tmpdir.name, "sleep.py")
+        with open(self.unit_file, "w") as f:
+            f.write(_sleep_unit)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run_params(self, name, resources=None, isolate=False,
+                    crash=False, prepare_duration=0):
+        run_params = {"file": self.unit_file, "unit": None,
+                      "arguments": {"name": name, "duration": 0.2,
+                                    "crash": crash,
+                                    "prepare_duration": prepare_duration}}
+        if resources is not None:
+            run_params["resources"] = resources
+        if isolate:
+            run_params["isolate"] = True
+        return run_params
+
+    @asyncio.coroutine
+    def _run_experiments(self, experiments, n_workers, late_experiments=[],
+                         **kwargs):
+        # Returns the logged events, in order. The late experiments are
+        # submitted while the others are being prepared.
+        log = []
+        scheduler = Scheduler({
+            "set_parameter": lambda name, value: log.append(value),
+            "init_rt_results": lambda rid, description: None
+        }, n_workers, **kwargs)
+        yield from scheduler.start()
+        try:
+            for run_params in experiments:
+                scheduler.run_queued(run_params, 10.0)
+            if late_experiments:
+                yield from asyncio.sleep(0.2)
+                for run_params in late_experiments:
+                    scheduler.run_queued(run_params, 10.0)
+            t = time()
+            while scheduler.queue.read:
+                self.assertLess(time() - t, 10.0)
+                yield from asyncio.sleep(0.02)
+        finally:
+            yield from scheduler.stop()
+        return log
+
+    def _run(self, experiments, n_workers, **kwargs):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            log = loop.run_until_complete(
+                self._run_experiments(experiments, n_workers, **kwargs))
+        finally:
+            loop.close()
+        return log
+
+    def _run_events(self, experiments, n_workers, late_experiments=[]):
+        log = self._run(experiments, n_workers,
+                        late_experiments=late_experiments)
+        return [event[0] + event[1] for event in log]
+
+    def _run_pids(self, experiments, **kwargs):
+        log = self._run(experiments, 1, **kwargs)
+        return [event[2] for event in log if event[0] == "start"]
+
+    def test_serial(self):
+        rp = self._run_params
+        log = self._run_events([rp("a"), rp("b", []), rp("c")], 1)
+        self.assertEqual(log, [stage + name for name in "abc"
+                               for stage in ("prepare", "start", "end",
+                                             "analyze")])
+
+    def test_resources(self):
+        rp = self._run_params
+        log = self._run_events([rp("a"), rp("b", ["core"]), rp("c", []),
+                                rp("d", ["dds"]), rp("e", ["dds"])], 3)
+        # a, c and d run concurrently, b and e wait
+        starts = [event for event in log if event.startswith("start")]
+        self.assertEqual(sorted(starts[:3]), ["starta", "startc", "startd"])
+        self.assertLess(log.index("enda"), log.index("startb"))
+        self.assertLess(log.index("endd"), log.index("starte"))
+
+    def test_stages(self):
+        rp = self._run_params
+        log = self._run_events([rp("a"), rp("b"), rp("c", ["dds"])], 3)
+        # b is prepared after a has closed its devices, and may use the
+        # parameters set by its analyze stage, but c does not wait
+        self.assertLess(log.index("analyzea"), log.index("prepareb"))
+        self.assertLess(log.index("preparec"), log.index("enda"))
+
+    def _priority_while_prepared(self, n_workers):
+        # The experiment with a higher priority waits for the resources of
+        # the started ones, and must not keep them from completing.
+        rp = self._run_params
+        experiments = [rp(str(i), [str(i)], prepare_duration=0.5)
+                       for i in range(n_workers)]
+        late = rp("late", [str(i) for i in range(n_workers)])
+        late["priority"] = 1
+        log = self._run_events(experiments, n_workers, [late])
+        for i in range(n_workers):
+            self.assertLess(log.index("analyze" + str(i)),
+                            log.index("preparelate"))
+        self.assertIn("analyzelate", log)
+
+    def test_priority_while_prepared(self):
+        self._priority_while_prepared(1)
+
+    def test_priority_while_prepared_pool(self):
+        self._priority_while_prepared(2)
+
+    def test_spare_worker(self):
+        rp = self._run_params
+        pids = self._run_pids([rp("a"), rp("b"), rp("c", crash=True),
+                               rp("d"), rp("e", isolate=True), rp("f")])
+        self.assertEqual(len(pids), 6)
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[1], pids[2])
+        # replaced after the crash
+        self.assertNotEqual(pids[2], pids[3])
+        self.assertEqual(pids[3], pids[4])
+        self.assertNotEqual(pids[4], pids[5])
+
+    def test_spare_failure(self):
+        @asyncio.coroutine
+        def create_spare(scheduler):
+            raise OSError("Spare worker disabled")
+
+        rp = self._run_params
+        with patch.object(Scheduler, "_create_spare", create_spare):
+            pids = self._run_pids([rp("a", crash=True), rp("b"), rp("c")])
+        # the process of the worker is restarted
+        self.assertEqual(len(pids), 3)
+        self.assertNotEqual(pids[0], pids[1])
+        self.assertEqual(pids[1], pids[2])
+
+    def test_isolate(self):
+        rp = self._run_params
+        pids = self._run_pids([rp("a"), rp("b"), rp("c")], isolate=True)
+        self.assertEqual(len(set(pids)), 3)
+
+    def test_queue_order(self):
+        scheduler = Scheduler(dict())
+        rp = self._run_params
+        now = time()
+
+        def with_options(run_params, **options):
+            run_params.update(options)
+            return run_params
+
+        rids = [
+            scheduler.run_queued(rp("a"), None),
+            scheduler.run_queued(with_options(rp("b"), priority=1), None),
+            scheduler.run_queued(with_options(rp("c"), due_date=now + 10),
+                                 None),
+            scheduler.run_queued(with_options(rp("d"), due_date=now + 5),
+                                 None),
+            scheduler.run_queued(rp("e"), None),
+            scheduler.run_queued(with_options(rp("f"), priority=-1), None)
+        ]
+        self.assertEqual([rid for rid, _, _ in scheduler.queue.read],
+                         [rids[i] for i in (1, 3, 2, 0, 4, 5)])
+        scheduler.cancel_queued(rids[2])
+        scheduler.cancel_queued(rids[1])
+        self.assertEqual([rid for rid, _, _ in scheduler.queue.read],
+                         [rids[i] for i in (3, 0, 4, 5)])
+        self.assertRaises(KeyError, scheduler.cancel_queued, rids[1])
+
+    def test_timed(self):
+        scheduler = Scheduler(dict())
+        rp = self._run_params
+        now = time()
+        trids = [scheduler.run_timed(rp(str(i)), None, now + 1000 - i)
+                 for i in range(100)]
+        self.assertEqual(trids, list(range(100)))
+        scheduler.run_queued(rp("queued"), None)
+        for trid in range(0, 100, 2):
+            scheduler.cancel_timed(trid)
+        self.assertEqual(scheduler.run_timed(rp("late"), None, now - 10), 0)
+        scheduler.run_timed(rp("later"), None, now - 5)
+        scheduler.run_timed(rp("cancelled"), None, now - 1)
+        # reuses TRID 6 with the time of a cancelled experiment
+        self.assertEqual(scheduler.run_timed(rp("reused"), None,
+                                             now + 1000 - 6), 6)
+        scheduler.cancel_timed(4)
+        next_timed = scheduler._queue_timed()
+        self.assertAlmostEqual(next_timed, 1000 - 99, delta=1)
+        self.assertEqual([run_params["arguments"]["name"]
+                          for _, run_params, _ in scheduler.queue.read],
+                         ["late", "later", "queued"])
+        self.assertEqual(len(scheduler.timed.read), 51)
+        self.assertEqual(scheduler.timed.read[6][1]["arguments"]["name"],
+                         "reused")
+
+    def test_cron(self):
+        def next_time(expression, date):
+            t = CronSchedule(expression).next_time(date.timestamp())
+            return datetime.fromtimestamp(t)
+
+        # a Wednesday
+        date = datetime(2015, 1, 7, 12, 30, 15)
+        self.assertEqual(next_time("* * * * *", date),
+                         datetime(2015, 1, 7, 12, 31))
+        self.assertEqual(next_time("*/20 * * * *", date),
+                         datetime(2015, 1, 7, 12, 40))
+        self.assertEqual(next_time("0 9-17/4 * * *", date),
+                         datetime(2015, 1, 7, 13, 0))
+        self.assertEqual(next_time("15,45 3 * * *", date),
+                         datetime(2015, 1, 8, 3, 15))
+        self.assertEqual(next_time("0 0 * * 0", date),
+                         datetime(2015, 1, 11))
+        self.assertEqual(next_time("0 0 * * 7", date),
+                         datetime(2015, 1, 11))
+        self.assertEqual(next_time("0 0 1 * 1", date),
+                         datetime(2015, 1, 12))
+        self.assertEqual(next_time("0 0 29 2 *", date),
+                         datetime(2016, 2, 29))
+        for expression in ("* * * *", "60 * * * *", "* * 0 * *",
+                           "*/0 * * * *", "0 0 30 2 *"):
+            self.assertRaises(ValueError, next_time, expression, date)
+
+    def test_recurring(self):
+        scheduler = Scheduler(dict())
+        rp = self._run_params
+        now = time()
+
+        def recurring(name, **options):
+            run_params = rp(name)
+            run_params.update(options)
+            return run_params
+
+        once = scheduler.run_timed(recurring("once", period=10),
+                                   None, now - 25)
+        every = scheduler.run_timed(
+            recurring("all", period=10, catch_up="all"), None, now - 25)
+        cron = scheduler.run_timed(recurring("cron", cron="* * * * *"),
+                                   None, None)
+        self.assertRaises(ValueError, scheduler.run_timed,
+                          recurring("x", period=0), None, None)
+        self.assertRaises(ValueError, scheduler.run_timed,
+                          recurring("x", period=1, catch_up="x"), None, None)
+        self.assertEqual(len(scheduler.timed.read), 3)
+        self.assertLess(scheduler.timed.read[cron][0] - now, 60)
+
+        scheduler._queue_timed()
+        names = [run_params["arguments"]["name"]
+                 for _, run_params, _ in scheduler.queue.read]
+        self.assertEqual(sorted(names), ["all"]*3 + ["once"])
+        # the schedule does not drift
+        for trid in once, every:
+            self.assertEqual(scheduler.timed.read[trid][0], now + 5)
+        # the run of "once" has not started yet
+        scheduler.timed[once] = now - 5, scheduler.timed.read[once][1], None
+        heapq.heappush(scheduler._timed_heap, (now - 5, once))
+        scheduler._queue_timed()
+        self.assertEqual(len(scheduler.queue.read), 4)
+        self.assertEqual(scheduler.timed.read[once][0], now + 5)
+        scheduler.cancel_timed(once)
+        self.assertNotIn(once, scheduler._recurring_rids)
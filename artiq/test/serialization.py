@@ -21,6 +21,50 @@ class PYON(unittest.TestCase):
             self.assertEqual(pyon.decode(enc(_pyon_test_object)),
                              _pyon_test_object)
 
+    def test_deep(self):
+        obj = []
+        for i in range(10000):
+            obj = [obj]
+        # list comparison is recursive, compare the encoded strings instead
+        s = pyon.encode(obj)
+        self.assertEqual(pyon.encode(pyon.decode(s)), s)
+
+    def test_python_syntax(self):
+        self.assertEqual(pyon.decode("(1)"), 1)
+        self.assertEqual(pyon.decode("(1, )"), (1, ))
+        self.assertEqual(pyon.decode("[None, True, 'a\\'b', -1e-3, ]"),
+                         [None, True, "a'b", -1e-3])
+
+    def test_invalid(self):
+        for s in "", "[1 2]", "{1: }", "(1", "1 2", "foo", "__import__('os')":
+            with self.assertRaises(ValueError):
+                pyon.decode(s)
+
+    def test_incremental(self):
+        data = "".join(pyon.encode(x, pretty) + "\n"
+                       for x in (_pyon_test_object, [1, "\n"], {"a": {}})
+                       for pretty in (False, True))
+        decoder = pyon.Decoder()
+        objs = []
+        for i in range(0, len(data), 7):
+            objs += decoder.feed(data[i:i+7])
+        self.assertFalse(decoder.pending())
+        self.assertEqual(objs, [_pyon_test_object]*2 + [[1, "\n"]]*2
+                               + [{"a": {}}]*2)
+
+    def test_binary(self):
+        obj = [_pyon_test_object, None, 2**70, "\u03bc", {"a": ()},
+               np.arange(12, dtype=">i4").reshape(3, 4)[:, ::2]]
+        frame = b"".join(pyon.encode_binary(obj))
+        length = pyon.decode_binary_header(frame[:pyon.binary_header_size])
+        payload = frame[pyon.binary_header_size:]
+        self.assertEqual(length, len(payload))
+        obj_back = pyon.decode_binary(payload)
+        self.assertEqual(obj_back[:-1], obj[:-1])
+        self.assertTrue(np.array_equal(obj_back[-1], obj[-1]))
+        with self.assertRaises(ValueError):
+            pyon.decode_binary(payload[:-1])
+
 
 _json_test_object = {
     "a": "b",
@@ -0,0 +1,268 @@
+import unittest
+import asyncio
+from copy import deepcopy
+
+import numpy as np
+
+from artiq.protocols import sync_struct, pyon
+
+
+test_address = "::1"
+test_port = 7778
+
+
+def write_test_data(test_dict):
+    test_dict["list"] = []
+    test_dict["dict"] = {"a": 1}
+    for i in range(100):
+        test_dict["list"].append(i)
+        test_dict["dict"]["a"] = i
+    test_dict["list"].insert(0, [])
+    test_dict["list"][0].append("x")
+    test_dict["list"][0][0] = "y"
+    for i in range(3):
+        test_dict["list"][-1] = i
+        test_dict["list"].append(i)
+    test_dict["list"].pop(1)
+    del test_dict["dict"]["a"]
+    test_dict["dict"]["b"] = [1, 2]
+    test_dict["dict"]["b"].append(3)
+    test_dict["dict"]["b"] = []
+    test_dict["dict"]["b"].append(4)
+    test_dict["finished"] = True
+
+
+class SyncStructCase(unittest.TestCase):
+    def test_coalesce(self):
+        target = {"a": [], "b": [], "c": {}}
+        reference = deepcopy(target)
+        pending = []
+        notifier = sync_struct.Notifier(target)
+        notifier.publish = lambda n, mod: sync_struct.coalesce_mod(
+            pending, deepcopy(mod))
+        for i in range(50):
+            notifier["a"].append(i)
+            notifier["a"].extend([i, i])
+            notifier["b"].append([i])
+            notifier["b"][-1].append(i)
+            notifier["b"][-1].append(i)
+            notifier["c"]["k"] = i
+            if i % 10 == 0:
+                notifier["a"].insert(0, i)
+                notifier["c"][i] = i
+        self.assertLess(len(pending), 150)
+        sync_struct.process_mod(reference,
+                                {"action": "batch", "mods": pending})
+        self.assertEqual(reference, target)
+
+    def test_notifier_views(self):
+        target = {"a": [[1]], "b": {"c": []}}
+        reference = deepcopy(target)
+        notifier = sync_struct.Notifier(target)
+        notifier.publish = lambda n, mod: sync_struct.process_mod(
+            reference, deepcopy(mod))
+        self.assertIs(notifier["b"]["c"], notifier["b"]["c"])
+        notifier["a"][0].append(2)
+        notifier["a"].insert(0, [0])
+        notifier["a"][0].append(5)
+        notifier["a"][-1].extend(i for i in range(3, 5))
+        self.assertEqual(target["a"], [[0, 5], [1, 2, 3, 4]])
+        notifier["b"]["c"].append(1)
+        notifier["b"] = {"c": []}
+        notifier["b"]["c"].append(2)
+        self.assertEqual(target["b"], {"c": [2]})
+        self.assertEqual(reference, target)
+
+    def test_append_block(self):
+        target = {"a": [], "b": np.zeros((1, 2))}
+        reference = deepcopy(target)
+        pending = []
+
+        def publish(notifier, mod):
+            sync_struct.process_mod(reference, deepcopy(mod))
+            sync_struct.coalesce_mod(pending, deepcopy(mod))
+        notifier = sync_struct.Notifier(target)
+        notifier.publish = publish
+        a = notifier["a"]
+        storages = set()
+        for i in range(100):
+            notifier["a"].append_block(np.arange(i))
+            notifier["b"].append_block(np.ones((i, 2)))
+            storages.add(id(target["a"].base))
+        # storage grows geometrically
+        self.assertLess(len(storages), 10)
+        expected = np.concatenate([np.arange(i) for i in range(100)])
+        self.assertTrue(np.array_equal(target["a"], expected))
+        self.assertIs(a, notifier["a"])
+        self.assertIs(a.read, target["a"])
+        self.assertEqual(target["b"].shape, (len(expected) + 1, 2))
+        self.assertTrue(np.array_equal(reference["a"], expected))
+        self.assertTrue(np.array_equal(reference["b"], target["b"]))
+        self.assertEqual(len(pending), 2)
+        coalesced = {"a": [], "b": np.zeros((1, 2))}
+        sync_struct.process_mod(coalesced,
+                                {"action": "batch", "mods": pending})
+        self.assertTrue(np.array_equal(coalesced["a"], expected))
+        self.assertTrue(np.array_equal(coalesced["b"], target["b"]))
+
+    def test_init_cache(self):
+        test_dict = sync_struct.Notifier({"a": [1]})
+        publisher = sync_struct.Publisher({"test": test_dict})
+        for binary in (False, True):
+            init = publisher._encode_init("test", binary)
+            self.assertIs(publisher._encode_init("test", binary), init)
+        test_dict["a"].append(2)
+        init = publisher._encode_init("test", False)
+        self.assertEqual(pyon.decode(init.decode())["struct"],
+                         {"a": [1, 2]})
+        init = publisher._encode_init("test", True)
+        init = pyon.decode_binary(init[pyon.binary_header_size:])
+        self.assertEqual(init["struct"], {"a": [1, 2]})
+        self.assertEqual(init["seq"], 1)
+
+    @asyncio.coroutine
+    def _publish_and_check(self, binary):
+        test_dict = sync_struct.Notifier(dict())
+        publisher = sync_struct.Publisher({"test": test_dict},
+                                          coalesce_window=0.1)
+        yield from publisher.start(test_address, test_port)
+        try:
+            received = dict()
+            mods = []
+            finished = asyncio.Event()
+
+            def init(x):
+                received.clear()
+                received.update(x)
+                return received
+
+            def notify(mod):
+                mods.append(mod)
+                if received.get("finished"):
+                    finished.set()
+
+            subscriber = sync_struct.Subscriber("test", init, notify,
+                                                binary)
+            yield from subscriber.connect(test_address, test_port)
+            try:
+                # let the publisher register the subscriber
+                yield from asyncio.sleep(0.1)
+                write_test_data(test_dict)
+                yield from asyncio.wait_for(finished.wait(), 2)
+                self.assertEqual(received, test_dict.read)
+                self.assertLess(len(mods), 30)
+            finally:
+                yield from subscriber.close()
+        finally:
+            yield from publisher.stop()
+
+    @asyncio.coroutine
+    def _overflow(self, overflow_policy):
+        test_list = sync_struct.Notifier([])
+        publisher = sync_struct.Publisher({"test": test_list},
+                                          queue_limit=10,
+                                          overflow_policy=overflow_policy)
+        yield from publisher.start(test_address, test_port)
+        try:
+            received = []
+            inits = []
+            finished = asyncio.Event()
+
+            def init(x):
+                inits.append(x)
+                received[:] = x
+                return received
+
+            def notify(mod):
+                if received and received[-1] == "end":
+                    finished.set()
+
+            subscriber = sync_struct.Subscriber("test", init, notify)
+            yield from subscriber.connect(test_address, test_port)
+            try:
+                yield from asyncio.sleep(0.1)
+                # the subscriber cannot receive anything in the meantime
+                for i in range(100):
+                    test_list.append(i)
+                test_list.append("end")
+                stats = publisher.get_queue_stats()["test"]
+                self.assertEqual(stats["subscribers"], 1)
+                self.assertEqual(stats["overflows"], 10)
+                if overflow_policy == "resync":
+                    self.assertEqual(stats["queue_depths"], [1])
+                    yield from asyncio.wait_for(finished.wait(), 2)
+                    self.assertEqual(received, test_list.read)
+                    self.assertEqual(len(inits), 2)
+                else:
+                    yield from asyncio.wait_for(subscriber.receive_task, 2)
+                    self.assertEqual(received, [])
+            finally:
+                yield from subscriber.close()
+        finally:
+            yield from publisher.stop()
+
+    @asyncio.coroutine
+    def _resume(self, binary):
+        test_list = sync_struct.Notifier([])
+        publisher = sync_struct.Publisher({"test": test_list},
+                                          resume_buffer=1000)
+        yield from publisher.start(test_address, test_port)
+        try:
+            received = []
+            inits = []
+
+            def init(x):
+                inits.append(x)
+                received[:] = x
+                return received
+
+            @asyncio.coroutine
+            def reconnect_and_check():
+                yield from subscriber.connect(test_address, test_port)
+                for i in range(100):
+                    yield from asyncio.sleep(0.01)
+                    if received == test_list.read:
+                        break
+                self.assertEqual(received, test_list.read)
+                yield from subscriber.close()
+
+            subscriber = sync_struct.Subscriber("test", init, binary=binary)
+            test_list.append(0)
+            yield from reconnect_and_check()
+            test_list.extend(range(1, 10))
+            yield from reconnect_and_check()
+            self.assertEqual(len(inits), 1)
+            for i in range(10, 30):
+                test_list.append(i)
+            # the frames kept are bounded by their total size
+            self.assertLessEqual(publisher._history_size["test"], 1000)
+            yield from reconnect_and_check()
+            self.assertEqual(len(inits), 2)
+        finally:
+            yield from publisher.stop()
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_publish(self):
+        self._run(self._publish_and_check(False))
+
+    def test_publish_binary(self):
+        self._run(self._publish_and_check(True))
+
+    def test_resume(self):
+        self._run(self._resume(False))
+
+    def test_resume_binary(self):
+        self._run(self._resume(True))
+
+    def test_overflow_resync(self):
+        self._run(self._overflow("resync"))
+
+    def test_overflow_disconnect(self):
+        self._run(self._overflow("disconnect"))
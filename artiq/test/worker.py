@@ -0,0 +1,153 @@
+import unittest
+import asyncio
+import os
+import tempfile
+from time import monotonic
+
+from artiq.master.worker import Worker
+from artiq.master.rt_results import RTResults
+
+
+_parameter_unit = """
+from artiq.language.db import *
+
+
+class ReadParameters(AutoDB):
+    class DBKeys:
+        implicit_core = False
+        initial = Argument()
+        p = Parameter()
+        q = Parameter(5)
+
+    @staticmethod
+    def realtime_results():
+        return dict()
+
+    def run(self):
+        for i in range(100):
+            assert self.p == self.initial
+        self.p = self.initial + 1
+        assert self.p == self.initial + 1
+        for i in range(10):
+            assert self.q == 5
+"""
+
+
+_rt_results_unit = """
+import os
+import time
+
+from artiq.language.db import *
+
+
+class WriteResults(AutoDB):
+    class DBKeys:
+        implicit_core = False
+        x = Result()
+        y = Result()
+
+    @staticmethod
+    def realtime_results():
+        return {"x": "raw", "y": "raw"}
+
+    def run(self):
+        for i in range(1000):
+            self.x.append(i)
+            if i == 500:
+                # not on the channel to the master
+                os.write(1, b"halfway\\n")
+        self.y.append([])
+        # modifies the value of the previous mod
+        self.y[-1].append(1)
+        # the results are sent without waiting for the end of the run
+        time.sleep(0.5)
+"""
+
+
+class WorkerCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.unit_file = os.path.join(self.tmpdir.name, "read_parameters.py")
+        with open(self.unit_file, "w") as f:
+            f.write(_parameter_unit)
+        self.rt_results_file = os.path.join(self.tmpdir.name,
+                                            "write_results.py")
+        with open(self.rt_results_file, "w") as f:
+            f.write(_rt_results_unit)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @asyncio.coroutine
+    def _parameter_cache(self):
+        pdb = {"p": 1}
+        requests = []
+
+        def req_parameter(name):
+            requests.append(name)
+            return pdb[name]
+
+        def set_parameter(name, value):
+            pdb[name] = value
+            worker.invalidate_parameter(name)
+
+        worker = Worker({"req_parameter": req_parameter,
+                         "set_parameter": set_parameter,
+                         "init_rt_results": lambda description: None})
+        yield from worker.create_process()
+        try:
+            run_params = {"file": self.unit_file, "unit": None,
+                          "arguments": {"initial": 1}}
+            yield from worker.run(run_params, 10.0)
+            self.assertEqual(requests, ["p", "p", "q"])
+            self.assertEqual(worker.parameter_cache_stats,
+                             {"hits": 108, "misses": 3})
+            set_parameter("p", 10)
+            run_params["arguments"]["initial"] = 10
+            yield from worker.run(run_params, 10.0)
+            self.assertEqual(requests, ["p", "p", "q", "p", "p"])
+            self.assertEqual(worker.parameter_cache_stats,
+                             {"hits": 109, "misses": 2})
+            self.assertEqual(pdb["p"], 11)
+        finally:
+            yield from worker.end_process()
+
+    @asyncio.coroutine
+    def _rt_results(self):
+        rtr = RTResults()
+        updates = []
+
+        def update_rt_results(mod):
+            updates.append(monotonic())
+            rtr.update(mod)
+
+        worker = Worker({"init_rt_results": rtr.init,
+                         "update_rt_results": update_rt_results})
+        yield from worker.create_process()
+        try:
+            run_params = {"file": self.rt_results_file, "unit": None,
+                          "arguments": {}}
+            yield from worker.run(run_params, 10.0)
+            end = monotonic()
+        finally:
+            yield from worker.end_process()
+        data = rtr.groups.read["default"]["data"]
+        self.assertEqual(data["x"], list(range(1000)))
+        self.assertEqual(data["y"], [[1]])
+        # batched
+        self.assertLess(len(updates), 10)
+        self.assertLess(updates[-1], end - 0.3)
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_parameter_cache(self):
+        self._run(self._parameter_cache())
+
+    def test_rt_results(self):
+        self._run(self._rt_results())
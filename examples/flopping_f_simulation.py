@@ -45,7 +45,6 @@ class FloppingF(AutoDB):
             self.frequency.append(frequency)
             self.brightness.append(brightness)
             time.sleep(0.1)
-        self.analyze()
 
     def analyze(self):
         popt, pcov = curve_fit(lambda xdata, F0: [model(x, F0) for x in xdata],
@@ -23,7 +23,7 @@ class Transport(AutoDB):
         repeats = Argument(100)
         nbins = Argument(100)
 
-    def prepare(self, stop):
+    def calc_waveforms(self, stop):
         t = transport_data["t"][:stop]*self.speed
         u = transport_data["u"][:stop]
         # start a new frame
@@ -109,7 +109,7 @@ class Transport(AutoDB):
             self.histogram = []
             # non-kernel, calculate waveforms, build frames
             # could also be rpc'ed from repeat()
-            self.prepare(s)
+            self.calc_waveforms(s)
             # kernel part
             self.repeat()
             # live update 2d plot with current self.histogram